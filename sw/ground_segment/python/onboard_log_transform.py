@@ -2,84 +2,357 @@
 
 # Tool to convert hex log dumps generated by onboard_logger.c on vehicle into text format matching the rest of paparazzi
 
-import socket
 import struct
 import os
-import logging
 import sys
-import threading
-import string
+import binascii
+import time
+import multiprocessing
+from optparse import OptionParser
 
 sys.path.append(os.getenv("PAPARAZZI_HOME") + "/sw/lib/python")
 
 import messages_xml_map
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# size hint of the blocks of lines read and converted at once, in bytes
+CHUNK_SIZE = 1 << 20
+# ranges of the file handed to each process in --jobs mode, in bytes
+RANGE_SIZE = 8 << 20
+
+# numpy types of the struct format characters of messages_xml_map.data_types
+NUMPY_TYPES = { 'f' : '<f4',
+                'd' : '<f8',
+                'B' : 'u1',
+                'H' : '<u2',
+                'L' : '<u4',
+                'Q' : '<u8',
+                'b' : 'i1',
+                'h' : '<i2',
+                'l' : '<i4',
+                'q' : '<i8'
+              }
+
+def SplitLine(line):
+    """Return timestamp, ac_id, msg_id and binary payload of a dump line."""
+    # timestamp, pprz timestamp, ac_id, msg_id, then the hex dump of msg_id and payload
+    fields = line.split(None, 5)
+    ac_id = int(fields[2])
+    timestamp = float(fields[1])
+    msg_id = int(fields[3])
+    if len(fields) > 5:
+        payload = binascii.unhexlify(fields[5].replace(' ', '').rstrip())
+    else:
+        payload = ''
+    return (timestamp, ac_id, msg_id, payload)
+
 class OnboardLogTransformTool():
     def __init__(self):
         messages_xml_map.ParseMessages()
-        self.data_types = { 'float' : ['f', 4],
-                            'uint8' : ['B', 1],
-                            'uint16' : ['H', 2],
-                            'uint32' : ['L', 4],
-                            'int8' : ['b', 1],
-                            'int16' : ['h', 2],
-                            'int32' : ['l', 4]
-                            }
-
-    def Unpack(self, data_fields, type, start, length):
-        return struct.unpack(type, "".join(data_fields[start:start + length]))[0]
+        self.formats = {}
+        self.skipped_lines = 0
 
-    def ProcessLine(self, line):
-        fields = line.strip().split(' ')
-        [timestamp, pprz_tstamp, ac_id, msg_id] = fields[0:4]
-        data_fields = list(map(lambda x: chr(int(x, 16)), fields[5:]))
-        ac_id = int(ac_id)
-        timestamp = float(pprz_tstamp)
-        msg_id = int(msg_id)
-
-        # print "Next message: ", timestamp, pprz_tstamp, ac_id, msg_id
-        # print messages_xml_map.message_dictionary_id_name.keys()
-        # print messages_xml_map.message_dictionary_types.keys()
-
-        msg_name = messages_xml_map.message_dictionary_id_name['telemetry'][msg_id]
-        msg_fields = messages_xml_map.message_dictionary_types['telemetry'][msg_id]
-
-        result = "%f %i %s " % (timestamp, ac_id, msg_name)
-
-        field_offset = 0
-        for field in msg_fields:
-            if field[-2:] == "[]":
-                baseType = field[:-2]
-                array_length = int(self.Unpack(data_fields, 'B', field_offset, 1))
-                field_offset = field_offset + 1
-                for count in range(0, array_length):
-                    array_value = str(self.Unpack(data_fields, self.data_types[baseType][0], field_offset, self.data_types[baseType][1]))
-                    field_offset = field_offset + self.data_types[baseType][1]
-                    if (count == array_length - 1):
-                        result += array_value + " "
-                    else:
-                        result += array_value + ","
-            else:
-                result += str(self.Unpack(data_fields, self.data_types[field][0], field_offset, self.data_types[field][1])) + " "
-                field_offset = field_offset + self.data_types[field][1]
+    def LineFormat(self, msg_id):
+        """Format string of the output line, precompiled once per message."""
+        line_format = self.formats.get(msg_id)
+        if line_format is None:
+            msg_name = messages_xml_map.message_dictionary_id_name['telemetry'][msg_id]
+            field_count = len(messages_xml_map.message_dictionary_types['telemetry'][msg_id])
+            line_format = " ".join(["%%f %%i %s" % msg_name] + ["%s"] * field_count)
+            self.formats[msg_id] = line_format
+        return line_format
 
+    def ProcessLine(self, line):
+        (timestamp, ac_id, msg_id, payload) = SplitLine(line)
+        codec = messages_xml_map.message_dictionary_codecs['telemetry'][msg_id]
+        try:
+            (values, field_offset) = codec.unpack_from(payload)
+        except (struct.error, KeyError):
+            msg_name = messages_xml_map.message_dictionary_id_name['telemetry'][msg_id]
+            sys.stderr.write("finished without parsing %s\n" % msg_name)
+            return "%f %i %s" % (timestamp, ac_id, msg_name)
 
-            if (field_offset > len(data_fields)):
-                print "finished without parsing %s" % field
-                break
+        for (idx, value) in enumerate(values):
+            if isinstance(value, tuple):
+                values[idx] = ",".join(map(str, value))
+        return self.LineFormat(msg_id) % tuple([timestamp, ac_id] + values)
 
-        return result[:-1]
+    def ProcessLines(self, lines):
+        results = []
+        for line in lines:
+            try:
+                results.append(self.ProcessLine(line))
+            except (ValueError, IndexError, KeyError, TypeError, binascii.Error):
+                # status lines of the logger ("checksum mismatch", ...) or garbage
+                self.skipped_lines += 1
+        return results
 
-    def Run(self, logfile):
+    def Run(self, logfile, output = sys.stdout, output_format = 'text'):
         # open log file
         INPUT = open(logfile, "r")
-        for line in INPUT:
-            print self.ProcessLine(line)
+        collector = ColumnCollector()
+        while True:
+            lines = INPUT.readlines(CHUNK_SIZE)
+            if not lines:
+                break
+            if output_format != 'text':
+                collector.AddLines(lines)
+                continue
+            results = self.ProcessLines(lines)
+            if results:
+                output.write("\n".join(results))
+                output.write("\n")
         INPUT.close()
+        if output_format != 'text':
+            collector.Write(output, output_format)
+            self.skipped_lines += collector.skipped_lines
+        if self.skipped_lines:
+            sys.stderr.write("skipped %i lines that are not messages\n" % self.skipped_lines)
+
+class ColumnCollector():
+    """Gathers the messages of a dump for the columnar output formats.
+
+    Payloads are kept raw per (ac_id, msg_id) and only turned into one typed
+    array per field when written: a numpy.frombuffer over the concatenated
+    payloads for fixed-layout messages, the message codec otherwise. Array
+    fields are stored flattened, with their lengths in a <field>_len column.
+    """
+    def __init__(self):
+        messages_xml_map.ParseMessages()
+        # (ac_id, msg_id) -> (timestamps, payloads)
+        self.messages = {}
+        self.skipped_lines = 0
+
+    def AddLines(self, lines):
+        codecs = messages_xml_map.message_dictionary_codecs['telemetry']
+        for line in lines:
+            try:
+                (timestamp, ac_id, msg_id, payload) = SplitLine(line)
+                codec = codecs[msg_id]
+            except (ValueError, IndexError, KeyError, TypeError, binascii.Error):
+                self.skipped_lines += 1
+                continue
+            if not codec.supported:
+                self.skipped_lines += 1
+                continue
+            if codec.struct is not None:
+                if len(payload) < codec.size:
+                    self.skipped_lines += 1
+                    continue
+                payload = payload[:codec.size]
+            rows = self.messages.get((ac_id, msg_id))
+            if rows is None:
+                rows = self.messages[(ac_id, msg_id)] = ([], [])
+            rows[0].append(timestamp)
+            rows[1].append(payload)
+
+    def Merge(self, messages):
+        for (key, (timestamps, payloads)) in messages.items():
+            rows = self.messages.get(key)
+            if rows is None:
+                self.messages[key] = (timestamps, payloads)
+            else:
+                rows[0].extend(timestamps)
+                rows[1].extend(payloads)
+
+    def Columns(self):
+        """Yield (ac_id, msg_name, column_name, array) for every column."""
+        for ((ac_id, msg_id), (timestamps, payloads)) in sorted(self.messages.items()):
+            msg_name = messages_xml_map.message_dictionary_id_name['telemetry'][msg_id]
+            field_names = messages_xml_map.message_dictionary['telemetry'][msg_name]
+            field_types = messages_xml_map.message_dictionary_types['telemetry'][msg_id]
+            codec = messages_xml_map.message_dictionary_codecs['telemetry'][msg_id]
+            if codec.struct is not None and len(field_types) == 0:
+                # no payload to decode (e.g. PONG), only the arrival times
+                yield (ac_id, msg_name, 'timestamp', numpy.array(timestamps, dtype = numpy.float64))
+                continue
+            if codec.struct is not None:
+                dtype = numpy.dtype([(name, NUMPY_TYPES[messages_xml_map.data_types[field_type]])
+                                     for (name, field_type) in zip(field_names, field_types)])
+                records = numpy.frombuffer("".join(payloads), dtype = dtype)
+                yield (ac_id, msg_name, 'timestamp', numpy.array(timestamps, dtype = numpy.float64))
+                for name in field_names:
+                    yield (ac_id, msg_name, name, records[name].copy())
+                continue
+
+            columns = [[] for name in field_names]
+            kept_timestamps = []
+            for (timestamp, payload) in zip(timestamps, payloads):
+                try:
+                    (values, offset) = codec.unpack_from(payload)
+                except struct.error:
+                    continue
+                kept_timestamps.append(timestamp)
+                for (column, value) in zip(columns, values):
+                    column.append(value)
+            yield (ac_id, msg_name, 'timestamp', numpy.array(kept_timestamps, dtype = numpy.float64))
+            for (name, field_type, column) in zip(field_names, field_types, columns):
+                if field_type[-2:] == "[]":
+                    numpy_type = NUMPY_TYPES[messages_xml_map.data_types[field_type[:-2]]]
+                    yield (ac_id, msg_name, name, numpy.array([v for value in column for v in value], dtype = numpy_type))
+                    yield (ac_id, msg_name, name + '_len', numpy.array([len(value) for value in column], dtype = numpy.uint8))
+                else:
+                    numpy_type = NUMPY_TYPES[messages_xml_map.data_types[field_type]]
+                    yield (ac_id, msg_name, name, numpy.array(column, dtype = numpy_type))
+
+    def WriteNpz(self, path):
+        """Write all columns in one .npz archive, named ac_id/message/field."""
+        columns = {}
+        for (ac_id, msg_name, name, column) in self.Columns():
+            columns['%i/%s/%s' % (ac_id, msg_name, name)] = column
+        numpy.savez(path, **columns)
+
+    def WriteNpyDir(self, path):
+        """Write one memory-mappable path/ac_id/message/field.npy file per column."""
+        for (ac_id, msg_name, name, column) in self.Columns():
+            directory = os.path.join(path, str(ac_id), msg_name)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            numpy.save(os.path.join(directory, name + '.npy'), column)
+
+    def Write(self, path, output_format):
+        if output_format == 'npz':
+            self.WriteNpz(path)
+        else:
+            self.WriteNpyDir(path)
+
+def LoadColumns(path, ac_id, msg_name, names = None, mmap_mode = 'r'):
+    """Load the columns of one message from a npz archive or npy directory.
+
+    Returns a dictionary of column name to array, with the timestamp column.
+    names restricts the fields loaded; npy files are memory-mapped.
+    """
+    if os.path.isdir(path):
+        directory = os.path.join(path, str(ac_id), msg_name)
+        if names is None:
+            names = [f[:-4] for f in os.listdir(directory) if f.endswith('.npy')]
+        else:
+            names = ['timestamp'] + list(names)
+        return dict((name, numpy.load(os.path.join(directory, name + '.npy'), mmap_mode = mmap_mode))
+                    for name in names)
+    archive = numpy.load(path)
+    prefix = '%i/%s/' % (ac_id, msg_name)
+    if names is None:
+        names = [f[len(prefix):] for f in archive.files if f.startswith(prefix)]
+    else:
+        names = ['timestamp'] + list(names)
+    return dict((name, archive[prefix + name]) for name in names)
+
+def SplitRanges(logfile, range_size = RANGE_SIZE):
+    """Cut logfile into (start, end) byte ranges that begin and end on a line."""
+    size = os.path.getsize(logfile)
+    boundaries = [0]
+    INPUT = open(logfile, "r")
+    offset = range_size
+    while offset < size:
+        INPUT.seek(offset)
+        INPUT.readline()
+        boundary = INPUT.tell()
+        if boundary >= size:
+            break
+        boundaries.append(boundary)
+        offset = boundary + range_size
+    INPUT.close()
+    boundaries.append(size)
+    return zip(boundaries[:-1], boundaries[1:])
+
+# one converter per worker process, created by the pool initializer
+range_tool = None
+
+def InitRangeWorker():
+    global range_tool
+    range_tool = OnboardLogTransformTool()
+
+def ConvertRange(args):
+    (logfile, start, end, output_format) = args
+    INPUT = open(logfile, "r")
+    INPUT.seek(start)
+    lines = INPUT.read(end - start).splitlines()
+    INPUT.close()
+    if output_format != 'text':
+        collector = ColumnCollector()
+        collector.AddLines(lines)
+        return (collector.messages, end - start, collector.skipped_lines)
+    range_tool.skipped_lines = 0
+    results = range_tool.ProcessLines(lines)
+    text = "\n".join(results)
+    if results:
+        text += "\n"
+    return (text, end - start, range_tool.skipped_lines)
+
+def RunParallel(logfile, jobs, output = sys.stdout, progress = True, output_format = 'text'):
+    """Convert logfile with a pool of jobs processes, keeping the line order.
+
+    For the columnar formats output is the path to write and the columns
+    gathered by the workers are merged in file order.
+    """
+    ranges = SplitRanges(logfile)
+    total = os.path.getsize(logfile)
+    done = 0
+    skipped_lines = 0
+    start_time = time.time()
+    collector = ColumnCollector()
+    pool = multiprocessing.Pool(jobs, InitRangeWorker)
+    try:
+        # imap hands the chunks back in file order while the pool runs ahead
+        for (result, size, skipped) in pool.imap(ConvertRange, [(logfile, start, end, output_format) for (start, end) in ranges]):
+            if output_format == 'text':
+                output.write(result)
+            else:
+                collector.Merge(result)
+            done += size
+            skipped_lines += skipped
+            if progress:
+                elapsed = max(time.time() - start_time, 1e-6)
+                sys.stderr.write("\r%.1f/%.1f MB, %.1f MB/s" % (done / 1e6, total / 1e6, done / 1e6 / elapsed))
+    finally:
+        pool.close()
+        pool.join()
+    if output_format != 'text':
+        collector.Write(output, output_format)
+    if progress:
+        elapsed = max(time.time() - start_time, 1e-6)
+        sys.stderr.write("\nconverted %.1f MB in %.1f s with %i jobs (%.1f MB/s)\n" % (total / 1e6, elapsed, jobs, total / 1e6 / elapsed))
+    if skipped_lines:
+        sys.stderr.write("skipped %i lines that are not messages\n" % skipped_lines)
 
 def main():
-    log_transform = OnboardLogTransformTool()
-    log_transform.Run(sys.argv[1])
+    usage = "usage: %prog [options] log_dump" + "\n" + "Run %prog --help to list the options."
+    parser = OptionParser(usage)
+    parser.add_option("-o", "--output", dest="output",
+                      help="write the converted log to this file instead of stdout")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="number of processes converting the log in parallel")
+    parser.add_option("-q", "--quiet", dest="progress", action="store_false", default=True,
+                      help="don't report progress in --jobs mode")
+    parser.add_option("-f", "--format", dest="output_format",
+                      type="choice", choices=["text", "npz", "npy"], default="text",
+                      help="text log (default), npz archive or directory of npy files with one array per ac_id, message and field")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("incorrect number of arguments")
+
+    if options.output_format != "text":
+        if numpy is None:
+            parser.error("numpy is required for the %s format" % options.output_format)
+        if not options.output:
+            parser.error("specify the output path of the %s format with -o" % options.output_format)
+        output = options.output
+    elif options.output:
+        output = open(options.output, "w", CHUNK_SIZE)
+    else:
+        output = sys.stdout
+    if options.jobs > 1:
+        RunParallel(args[0], options.jobs, output, options.progress, options.output_format)
+    else:
+        log_transform = OnboardLogTransformTool()
+        log_transform.Run(args[0], output, options.output_format)
+    if options.output_format == "text" and options.output:
+        output.close()
 
 if __name__ == '__main__':
     main()
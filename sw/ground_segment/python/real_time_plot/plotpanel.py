@@ -8,16 +8,25 @@ import math
 import random
 import sys
 import os
+import numpy
+import threading
+from collections import deque
 import messagepicker
 
 sys.path.append(os.getenv("PAPARAZZI_HOME") + "/sw/lib/python")
 
 import messages_xml_map
 
+# removals from the running statistics before they are recomputed from the
+# ring, each removal adds a rounding error that is not averaged out
+STATS_RESYNC_REMOVALS = 64
+
 class plot_data:
     def __init__(self, ivy_msg_id, title, width, color = None):
         self.id = ivy_msg_id
         self.title = title
+        # points are added from the Ivy thread and drawn from the wx timer
+        self.lock = threading.RLock()
         self.SetPlotSize(width)
         self.x_min = 1e32
         self.x_max = 1e-32
@@ -45,22 +54,133 @@ class plot_data:
         self.scale = value
 
     def SetPlotSize(self, size):
-        self.size = size
-        self.index = size-1       # holds the index of the next point to add and the first point to draw
-        self.data = []            # holds the list of points to plot
-        for i in range(size):
-            self.data.append(None)
-
-        self.avg = 0.0
-        self.std_dev = 0.0
+        with self.lock:
+            self.size = size
+            self.index = size-1       # holds the index of the next point to add and the first point to draw
+            self.data = numpy.empty(size) # holds the ring of points to plot, NaN where there is no point
+            self.data.fill(numpy.nan)
+
+            self.avg = 0.0
+            self.std_dev = 0.0
+
+            # running count, mean and sum of squared deviations of the points (Welford)
+            self.count = 0
+            self.mean = 0.0
+            self.m2 = 0.0
+            self.removals = 0
+
+            # min and max of the points but the last written one (head), in monotonic
+            # deques of (seq, slot, point), an entry is stale once its slot is written again
+            self.head = None
+            self.seq = 0
+            self.slot_seq = [0] * size
+            self.min_deque = deque()
+            self.max_deque = deque()
+            self.dirty = False
+
+    def Store(self, slot, point):
+        old = self.data[slot]
+        if not math.isnan(old):
+            self.RemoveStat(old)
+        if not math.isnan(point):
+            self.AddStat(point)
+
+        if slot != self.head:
+            if self.head != None:
+                # the head can no longer be overwritten, it enters the deques
+                self.Commit(self.head)
+                if slot != (self.head + 1) % self.size:
+                    # out of the ring order, the deques are no longer ordered by age
+                    self.dirty = True
+            self.seq += 1
+            self.slot_seq[slot] = self.seq
+            self.head = slot
+        self.data[slot] = point
+
+        # resync the running statistics to bound the rounding errors of the removals
+        if self.removals >= STATS_RESYNC_REMOVALS:
+            self.ResetStats()
+
+    def Commit(self, slot):
+        point = self.data[slot]
+        if math.isnan(point) or self.dirty:
+            return
+        self.seq += 1
+        self.slot_seq[slot] = self.seq
+        entry = (self.seq, slot, point)
+        for (queue, keep) in ((self.min_deque, lambda x: x < point), (self.max_deque, lambda x: x > point)):
+            while queue and not keep(queue[-1][2]):
+                queue.pop()
+            queue.append(entry)
+            while self.slot_seq[queue[0][1]] != queue[0][0]:
+                queue.popleft()
+
+    def Rebuild(self):
+        self.ResetStats()
+        self.dirty = False
+        self.min_deque.clear()
+        self.max_deque.clear()
+        if self.head != None:
+            for i in range(1, self.size):
+                self.Commit((self.head + i) % self.size)
+
+    def AddStat(self, point):
+        self.count += 1
+        delta = point - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (point - self.mean)
+
+    def RemoveStat(self, point):
+        self.removals += 1
+        if self.count <= 1:
+            (self.count, self.mean, self.m2) = (0, 0.0, 0.0)
+            return
+        delta = point - self.mean
+        self.mean -= delta / (self.count - 1)
+        self.m2 = max(self.m2 - delta * (point - self.mean), 0.0)
+        self.count -= 1
+
+    def ResetStats(self):
+        self.removals = 0
+        points = self.data[~numpy.isnan(self.data)]
+        self.count = len(points)
+        if self.count > 0:
+            self.mean = points.mean()
+            self.m2 = ((points - self.mean)**2).sum()
+        else:
+            (self.mean, self.m2) = (0.0, 0.0)
+
+    def MinMax(self):
+        # (min, max) of the points, None if there is none
+        with self.lock:
+            if self.dirty:
+                self.Rebuild()
+            values = []
+            for queue in (self.min_deque, self.max_deque):
+                while queue and self.slot_seq[queue[0][1]] != queue[0][0]:
+                    queue.popleft()
+                if queue:
+                    values.append(queue[0][2])
+            if self.head != None and not math.isnan(self.data[self.head]):
+                values.append(self.data[self.head])
+            if len(values) == 0:
+                return None
+            return (min(values), max(values))
 
     def AddPoint(self, point, x_axis):
-        self.data[self.index] = point
+        with self.lock:
+            if x_axis != None:
+                self.index = x_axis.index
+            self.Store(self.index, point)
 
-        if self.real_time or (x_axis != None):
-            self.index = (self.index + 1) % self.size # increment index to next point
-            self.data[self.index] = None
+            if self.real_time or (x_axis != None):
+                self.index = (self.index + 1) % self.size # increment index to next point
+                self.Store(self.index, numpy.nan)
 
+    def Ordered(self, index):
+        # points of the ring from index, oldest first
+        with self.lock:
+            return numpy.concatenate((self.data[index:], self.data[:index]))
 
     def DrawTitle(self, dc, margin, width, height):
 
@@ -73,81 +193,62 @@ class plot_data:
         return h
 
     def DrawCurve(self, dc, width, height, margin, _max_, _min_, x_axis):
-        if width != self.size:
-            self.SetPlotSize(width)
-            return
+        with self.lock:
+            if width != self.size:
+                self.SetPlotSize(width)
+                return
 
-        if (not self.real_time) and (x_axis == None):
-            self.index = (self.index + 1) % self.size # increment index to next point
-            self.data[self.index] = None
+            if (not self.real_time) and (x_axis == None):
+                self.index = (self.index + 1) % self.size # increment index to next point
+                self.Store(self.index, numpy.nan)
 
-        if x_axis != None:
-            (x_min, x_max) = x_axis.GetXMinMax()
+            if _max_ < _min_:
+                (_min_, _max_) = (-1,1) #prevent divide by zero or inversion
+            if _max_ == _min_:
+                (_min_, _max_) = (_max_-0.5, _max_+0.5)
+            delta = _max_-_min_
+            dy = (height - margin*2) / delta
 
-        dc.SetPen(wx.Pen(self.color,1))
-        if _max_ < _min_:
-            (_min_, _max_) = (-1,1) #prevent divide by zero or inversion
-        if _max_ == _min_:
-            (_min_, _max_) = (_max_-0.5, _max_+0.5)
-        delta = _max_-_min_
-        dy = (height - margin*2) / delta
-
-        n = 0
-        sums = 0.0
-        sum_squares = 0.0
-        lines = []
-        point_1 = None
-        for i in range(self.size):
-            ix = (i+self.index) % self.size
-            point = self.data[ix]
-            if point == None:
-                continue
-            n += 1
-            sums = sums + point
-            sum_squares = sum_squares + (point*point)
+            if self.count > 0:
+                self.avg = self.mean
+                self.std_dev = math.sqrt(self.m2 / self.count)
+
+            points = self.Ordered(self.index)
+            valid = ~numpy.isnan(points)
 
             if x_axis != None:
-                x = x_axis.data[ix]
-                if x == None:
-                    continue
+                (x_min, x_max) = x_axis.GetXMinMax()
                 dx = (width-1) / (x_max-x_min)
-                x = int((x-x_min) * dx)
-
+                x = x_axis.Ordered(self.index)
+                valid &= ~numpy.isnan(x)
+                x = ((x[valid] - x_min) * dx).astype(int)
             else:
-                x = i * width / self.size
-
-            scaled_point = (point + self.offset) * self.scale
-            y = height - margin - int((scaled_point - _min_)*dy)
+                x = numpy.flatnonzero(valid) * width // self.size
 
-            if point_1 != None:
-                line = (point_1[0], point_1[1], x, y)
-                lines.append( line)
-            point_1 = (x,y)
-            dc.DrawLineList(lines)
+            y = height - margin - ((((points[valid] + self.offset) * self.scale) - _min_) * dy).astype(int)
 
-            if n > 0:
-                self.avg = sums / n
-                self.std_dev = math.sqrt(math.fabs((sum_squares / n) - (self.avg * self.avg)))
+            if len(x) > 1:
+                lines = numpy.column_stack((x[:-1], y[:-1], x[1:], y[1:]))
+                dc.SetPen(wx.Pen(self.color,1))
+                dc.DrawLineList(lines.tolist())
 
     def GetXMinMax(self):
-        x_min = 1e32
-        x_max = -1e32
-
-        for i in range(self.size):
-            point = self.data[i]
-            if point == None: continue
-
-            x_min = min( x_min, point)
-            x_max = max( x_max, point)
+        with self.lock:
+            min_max = self.MinMax()
+            if min_max != None:
+                (x_min, x_max) = min_max
+            else:
+                x_min = 1e32
+                x_max = -1e32
 
-        if x_max < x_min:
-            (x_min, x_max) = (-1,1) #prevent divide by zero or inversion
-        if x_max == x_min:
-            (x_min, x_max) = (x_max-0.5, x_max+0.5)
+            if x_max < x_min:
+                (x_min, x_max) = (-1,1) #prevent divide by zero or inversion
+            if x_max == x_min:
+                (x_min, x_max) = (x_max-0.5, x_max+0.5)
 
-        self.x_max = x_max
-        self.x_min = x_min
-        return (x_min, x_max)
+            self.x_max = x_max
+            self.x_min = x_min
+            return (x_min, x_max)
 
 
 _IVY_APPNAME='JobyPlot'
@@ -209,6 +310,12 @@ class PlotPanel():
     def ResetScale(self):
         self.max = -1e32
         self.min = 1e32
+        for ac_id in self.plots:
+            for message in self.plots[ac_id]:
+                for field in self.plots[ac_id][message]:
+                    plot = self.plots[ac_id][message][field]
+                    if (self.x_axis == None) or (self.x_axis.id != plot.id):
+                        self.CalcMinMax(plot)
 
     def OnClose(self):
         self.timer.Stop()
@@ -268,8 +375,6 @@ class PlotPanel():
                     self.max = max( self.max, scaled_point)
                     self.min = min( self.min, scaled_point)
 
-            if self.x_axis != None:
-                plot.index = self.x_axis.index
             plot.AddPoint(point, self.x_axis)
 
     def BindCurve(self, ac_id, message, field, color = None, use_as_x = False):
@@ -296,10 +401,12 @@ class PlotPanel():
 
     def CalcMinMax(self, plot):
         if not self.auto_scale: return
-        for x in plot.data:
-            self.max = max(self.max, x)
-            self.min = min(self.min, x)
-            self.frame.SetMinMax(self.min, self.max)
+        min_max = plot.MinMax()
+        if min_max == None: return
+        scaled = [(x + plot.offset) * plot.scale for x in min_max]
+        self.max = max(self.max, max(scaled))
+        self.min = min(self.min, min(scaled))
+        self.frame.SetMinMax(self.min, self.max)
 
     def FindPlotName(self, ivy_id):
         for ac_id in self.plots:
@@ -335,8 +442,7 @@ class PlotPanel():
           return
 
       plot.SetOffset(offset)
-      print('panel value: %.2f' % value)
-      CalcMinMax(plot)
+      self.CalcMinMax(plot)
 
     def ScalePlot(self, ivy_id, offset):
       plot = self.FindPlot( ivy_id)
@@ -344,7 +450,7 @@ class PlotPanel():
           return
 
       plot.SetScale(offset)
-      CalcMinMax(plot)
+      self.CalcMinMax(plot)
 
     def SetRealTime(self, ivy_id, value):
       plot = self.FindPlot( ivy_id)
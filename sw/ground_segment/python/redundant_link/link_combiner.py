@@ -28,6 +28,9 @@ import sys
 import os
 import argparse
 from time import time
+from collections import deque
+import heapq
+import random
 import threading
 from ivy.std_api import *
 
@@ -35,70 +38,125 @@ PPRZ_HOME = os.getenv("PAPARAZZI_HOME")
 sys.path.append(PPRZ_HOME + "/sw/lib/python")
 import messages_xml_map
 
-class Circular_Buffer:
-    def __init__(self, size):
-        self.buffer = [""]*size
-        self.index = 0
+# part of the period by which each LINK_STATUS is randomly advanced or delayed
+LINK_STATUS_JITTER = 0.1
+# link score: seconds added for a fully lossy link, and smoothing factor of its moving average
+LINK_SCORE_LOSS_PENALTY = 1.0
+LINK_SCORE_SMOOTHING = 0.2
+
+# a message repeated by a link sooner than this part of the period of its stream is counted as a duplicate
+DUPLICATE_FRACTION = 0.5
+# smoothing factor of the moving average of the period of each stream
+PERIOD_SMOOTHING = 0.2
+# indexes of the link counters of Message_Stream
+RECEIVED, EXPECTED, LOST, REORDERED, DUPLICATES = range(5)
+# indexes of the entries of Message_Stream
+ENTRY_TIME, ENTRY_CONTENTS, ENTRY_FORWARDED = range(3)
+
+class Message_Stream:
+    """Arrivals of the messages of one name of one aircraft on every link.
+
+    Every message sent by the aircraft gets an entry [time, contents,
+    forwarded] with a sequence number, the copies received by the other links
+    are matched to it by contents. The sequence numbers received by each link
+    are kept in a bitmap (bit i for the entry base + i): a message is a copy
+    of the oldest matching entry that this link has not received yet, so an
+    identical message sent again by the aircraft gets a new entry instead of
+    being taken as a copy. An entry is no longer matched after size newer
+    entries or after max_age seconds, and the links which did not receive it
+    are counted as having lost it.
+    """
+    def __init__(self, size, max_age=0):
         self.size = size
-
-    def add(self, contents):
-        self.buffer[self.index] = contents
-        self.incr()
-
-    def contains(self, contents):
-        counter = self.index
-        while 1:
-            if self.buffer[counter] == contents:
-                return 1
+        self.max_age = max_age
+        self.base = 0                   #The sequence number of the oldest entry
+        self.entries = deque()
+        self.seqs = {}                  #The sequence numbers of the entries of each contents
+        self.bits = {}                  #The bitmap of the entries received by each link
+        self.first_seq = {}             #The first sequence number expected from each link
+        self.last_seq = {}              #The highest sequence number received by each link
+        self.counters = {}              #The RECEIVED, EXPECTED, LOST, REORDERED, DUPLICATES counters of each link
+        self.period = None
+        self.last_time = None
+
+    def arrival(self, link_name, contents, now):
+        #Returns the entry of the message and whether it is a new one, or (None, False) for a duplicate.
+        self.evict(now)
+        if link_name not in self.bits:
+            self.bits[link_name] = 0
+            self.first_seq[link_name] = self.base + len(self.entries)
+            self.last_seq[link_name] = -1
+            self.counters[link_name] = [0] * 5
+        counters = self.counters[link_name]
+        bits = self.bits[link_name]
+
+        seqs = self.seqs.get(contents, ())
+        for seq in seqs:
+            if not (bits >> (seq - self.base)) & 1:     #Copy of a message received by another link
+                self.receive(link_name, seq)
+                return self.entries[seq - self.base], False
+        if seqs and self.period is not None and now - self.entries[seqs[-1] - self.base][ENTRY_TIME] < DUPLICATE_FRACTION * self.period:
+            counters[DUPLICATES] += 1
+            return None, False
+
+        seq = self.base + len(self.entries)
+        entry = [now, contents, False]
+        self.entries.append(entry)
+        self.seqs.setdefault(contents, deque()).append(seq)
+        if self.last_time is not None:
+            if self.period is None:
+                self.period = now - self.last_time
             else:
-                if counter <= 0:
-                    counter = self.size-1    #Moving the counter in the reverse direction of the index in order to test the most recent contents first (since they're most likely to match)
-                else:
-                    counter -= 1
-                if counter == self.index:
-                    return 0
-
-    def incr(self):
-        if self.index >= (self.size - 1):
-            self.index = 0
+                self.period += PERIOD_SMOOTHING * (now - self.last_time - self.period)
+        self.last_time = now
+        self.receive(link_name, seq)
+        return entry, True
+
+    def receive(self, link_name, seq):
+        self.bits[link_name] |= 1 << (seq - self.base)
+        counters = self.counters[link_name]
+        counters[RECEIVED] += 1
+        if seq < self.last_seq[link_name]:
+            counters[REORDERED] += 1
         else:
-            self.index += 1
-
-    def remove(self, contents):
-        counter = self.index
-        while 1:
-            if self.buffer[counter] == contents:
-                self.buffer[counter] = ""
-            else:
-                if counter <= 0:
-                    counter = self.size-1
-                else:
-                    counter -= 1
-                if counter == self.index:
-                    return
+            self.last_seq[link_name] = seq
+
+    def evict(self, now):
+        while self.entries and (len(self.entries) >= self.size or (self.max_age > 0 and now - self.entries[0][ENTRY_TIME] > self.max_age)):
+            entry = self.entries.popleft()
+            seqs = self.seqs[entry[ENTRY_CONTENTS]]
+            seqs.popleft()
+            if not seqs:
+                del self.seqs[entry[ENTRY_CONTENTS]]
+            for link_name, bits in self.bits.items():
+                if self.first_seq[link_name] <= self.base:
+                    counters = self.counters[link_name]
+                    counters[EXPECTED] += 1
+                    if not bits & 1:
+                        counters[LOST] += 1
+                self.bits[link_name] = bits >> 1
+            self.base += 1
+
+class Message(object):
+    """Telemetry message received by one link.
+
+    The raw message is split once to get its name, the field values are only
+    decoded when values() is called, which only happens for DOWNLINK_STATUS.
+    """
+    __slots__ = ('link_name', 'raw_sender', 'raw_message', 'msg_name', 'raw_fields', 'raw_values')
 
-    def displayContents(self):
-        for counter in xrange(0,self.size):
-            if self.index != counter:
-                print("   %s" %self.buffer[counter], file=sys.stderr)
-            else:
-                print("-> %s" %self.buffer[counter], file=sys.stderr)
-
-class Message:
     def __init__(self, sender, link_name, raw_message):
 
         self.link_name = link_name
         self.raw_sender = sender
-        self.raw_message = " ".join(raw_message.split(";"))
-
-        if self.name() not in messages_xml_map.message_dictionary['telemetry']:
-            raise(Exception("Error in link_combiner: unknown message name: %s" %self.name()))
+        self.raw_message = raw_message.replace(";", " ")
 
-        value_names = messages_xml_map.message_dictionary['telemetry'][self.name()]
-        values = self.raw_message.split(" ")[1:-1]
-        self.raw_values = {}
-        map(lambda k, v: self.raw_values.update({k: v}), value_names, values)
-        # self.raw_values = dict(zip(value_names, values))  #This doesn't work for some reason. It gives weird errors, seemingly related to the ivy bus
+        parts = self.raw_message.split(" ", 2)
+        if len(parts) < 2 or parts[1] not in messages_xml_map.message_dictionary['telemetry']:
+            raise(Exception("Error in link_combiner: unknown message: %s" %self.raw_message))
+        self.msg_name = parts[1]
+        self.raw_fields = parts[2] if len(parts) > 2 else ""
+        self.raw_values = None
 
     def linkName(self):
         return self.link_name
@@ -110,16 +168,18 @@ class Message:
         return self.raw_sender
 
     def name(self):
-        return self.raw_message.split(" ")[1]
+        return self.msg_name
 
     def values(self):
+        if self.raw_values is None:
+            value_names = messages_xml_map.message_dictionary['telemetry'][self.msg_name]
+            self.raw_values = dict(zip(value_names, self.raw_fields.split()))
         return self.raw_values
 
 
 
 class Link:
-    def __init__(self, name, ac_id, buffer_size=10, verbose=0):
-        self.buffer = Circular_Buffer(buffer_size)
+    def __init__(self, name, ac_id, verbose=0):
         self.name = name
         self.time_of_last_message = time()
         self.verbose = verbose
@@ -134,18 +194,9 @@ class Link:
         self.rx_msgs_rate = 0
         self.ping_time = 0
 
+        # Moving average of the latency and loss measured by DOWNLINK_STATUS, in seconds, see score()
+        self.quality = None
 
-    def checkBuffer(self,message):
-        return self.buffer.contains(message.message())
-
-    def addToBuffer(self,message):
-        self.buffer.add(message.message())
-        if self.verbose:
-            print("%s Buffer:" % self.name, file=sys.stderr)
-            self.buffer.displayContents();
-
-    def removeFromBuffer(self,message):
-        self.buffer.remove(message.message())
 
     def updateTimeOfLastMessage(self):
         self.time_of_last_message = time()
@@ -153,26 +204,24 @@ class Link:
     def timeSinceLastMessage(self):
         return time() - self.time_of_last_message
 
-    def acAc(self, ac_id):
+    def addAc(self, ac_id):
         self.acs = self.acs + [ac_id]
 
     def aircrafts(self):
         return self.acs
 
-    def sendLinkStatusMessage(self):
-        for ac_id in self.acs:
-            values = (  self.name, 
-                        self.timeSinceLastMessage(), 
-                        self.run_time, 
-                        self.rx_bytes, 
-                        self.rx_msgs, 
-                        self.rx_err, 
-                        self.rx_bytes_rate, 
-                        self.rx_msgs_rate,
-                        self.ping_time)
-
-            IvySendMsg("%s LINK_STATUS %s %f %s %s %s %s %s %s %s" % ((ac_id,) + values))
-            threading.Timer(LINK_STATUS_PERIOD, self.sendLinkStatusMessage).start()
+    def sendLinkStatusMessage(self, ac_id):
+        values = (  self.name, 
+                    self.timeSinceLastMessage(), 
+                    self.run_time, 
+                    self.rx_bytes, 
+                    self.rx_msgs, 
+                    self.rx_err, 
+                    self.rx_bytes_rate, 
+                    self.rx_msgs_rate,
+                    self.ping_time)
+
+        IvySendMsg("%s LINK_STATUS %s %f %s %s %s %s %s %s %s" % ((ac_id,) + values))
 
     def updateStatus(self, downlink_status_message):
 
@@ -180,6 +229,7 @@ class Link:
             raise(Exception("function called with message of name other than DOWNLINK_STATUS"))
 
         message_values = downlink_status_message.values()
+        self.updateQuality(message_values)
 
         self.run_time = message_values['run_time']
         self.rx_bytes = message_values['rx_bytes']
@@ -189,14 +239,94 @@ class Link:
         self.rx_msgs_rate = message_values['rx_msgs_rate']
         self.ping_time = message_values['ping_time']
 
-
+    def updateQuality(self, message_values):
+        try:
+            ping_time = float(message_values['ping_time'])
+            rx_err = int(message_values['rx_err'])
+            rx_msgs = int(message_values['rx_msgs'])
+            new_err = rx_err - int(self.rx_err)
+            new_msgs = rx_msgs - int(self.rx_msgs)
+        except (KeyError, ValueError):
+            return
+        if new_err > 0 and new_msgs >= 0:
+            loss = float(new_err) / (new_err + new_msgs)
+        else:   #No new error, or the counters were reset
+            loss = 0.
+        sample = ping_time / 1000 + LINK_SCORE_LOSS_PENALTY * loss
+        if self.quality is None:
+            self.quality = sample
+        else:
+            self.quality += LINK_SCORE_SMOOTHING * (sample - self.quality)
+
+    def score(self):
+        #The lower the better: latency and loss of the link, plus the time since it last received a message
+        return (self.quality or 0.) + self.timeSinceLastMessage()
+
+
+
+
+class Link_Status_Scheduler:
+    """Single thread sending the LINK_STATUS of every (link, aircraft) pair.
+
+    The next send time of each pair is kept in a heap. Each pair starts at a
+    random phase of the period and every send is jittered by a part of the
+    period, so that the messages of many pairs are spread over the period.
+    """
+    def __init__(self, period, send, jitter=LINK_STATUS_JITTER):
+        self.period = period
+        self.send = send
+        self.jitter = jitter
+        self.heap = []
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, link_name, ac_id):
+        with self.condition:
+            heapq.heappush(self.heap, (time() + random.uniform(0, self.period), link_name, ac_id))
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.heap or self.heap[0][0] > time()):
+                    if self.heap:
+                        self.condition.wait(self.heap[0][0] - time())
+                    else:
+                        self.condition.wait()
+                if not self.running:
+                    return
+                now = time()
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    (send_time, link_name, ac_id) = heapq.heappop(self.heap)
+                    due.append((link_name, ac_id))
+                    next_time = send_time + self.period * (1 + random.uniform(-self.jitter, self.jitter))
+                    if next_time <= now:    #Late, skipping the missed sends instead of sending a burst
+                        next_time = now + self.period
+                    heapq.heappush(self.heap, (next_time, link_name, ac_id))
+            for (link_name, ac_id) in due:
+                self.send(link_name, ac_id)
 
 
 class Link_Combiner:
 
-    def __init__(self):
+    def __init__(self, verbose=0):
 
         self.links = {}
+        self.streams = {}           #The Message_Stream of each (aircraft, message name)
+        self.verbose = verbose
+        self.preferred_links = {}   #The link forwarded for each aircraft in selection mode
+        self.pending = deque()      #The (deadline, entry) of the messages of the other links waiting for the preferred link
+        self.lock = threading.Lock()    #Guards the links, streams and pending messages
+        self.scheduler = Link_Status_Scheduler(LINK_STATUS_PERIOD, self.sendLinkStatusMessage)
 
         self.initIvy()
 
@@ -218,64 +348,110 @@ class Link_Combiner:
 
         message = Message(larg[1], larg[2], larg[3])
 
-        if message.linkName() not in self.links: #Adding a new link
-            self.links[message.linkName()] = Link(message.linkName(), message.sender(), BUFFER_SIZE)
-            # print("NEW LINK DETECTED: %s" %message.linkName(), file=sys.stderr)
-            self.repeatSendLinkStatusMessage(message)
+        #Each link agent calls this from its own Ivy thread, and the scheduler thread reads the statistics
+        with self.lock:
+            if message.linkName() not in self.links: #Adding a new link
+                self.links[message.linkName()] = Link(message.linkName(), message.sender())
+                # print("NEW LINK DETECTED: %s" %message.linkName(), file=sys.stderr)
+                self.scheduler.add(message.linkName(), message.sender())
+
+            #Processing messages from an already added link
+            link = self.links[message.linkName()]
+            if SELECT_LINK and message.name() != "DOWNLINK_STATUS":
+                self.selectMessage(message)
+            else:
+                self.sendMessage(message)
+            if message.name() != "DOWNLINK_STATUS":
+                link.updateTimeOfLastMessage()
+            else:
+                link.updateStatus(message)
+            if message.sender() not in link.aircrafts():
+                link.addAc(message.sender())
+                self.scheduler.add(message.linkName(), message.sender())
 
-        #Processing messages from an already added link
-        link = self.links[message.linkName()]
-        self.sendMessage(message)
-        self.bufferMessage(message)
-        if message.name() != "DOWNLINK_STATUS":
-            link.updateTimeOfLastMessage()
-        else:
-            link.updateStatus(message)
-        if message.sender() not in link.aircrafts():
-            link.addAc(message.sender())
 
+    def stream(self, message):
+        key = (message.sender(), message.name())
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = self.streams[key] = Message_Stream(BUFFER_SIZE, WINDOW_TIME)
+        return stream
 
     def sendMessage(self, message):
+        #Forwarding the first copy of each message received by any link.
+        #The DOWNLINK_STATUS messages are specific to each link, so they are all forwarded.
 
-        in_buffer = self.checkBuffers(message)
-        if not in_buffer:
-            IvySendMsg(message.message())
-            return True
-        else:
-            return False
-
-    def checkBuffers(self, message):
-        #The returned value is the best guess at whether the message is a duplicate (True), or not (False).
-        #If the message is already in this link's buffer, then taking it as not a duplicate. So returning False. But also, removing it from all buffers. So that when they receive it, they don't do the same.
-        #If the message is not in this link's buffer, then checking all other buffers and only if it's not in any of them, counting the message as not a duplicate.
-
-        match = self.links[message.linkName()].checkBuffer(message) 
-        if match:   #Removing the message from all buffers
-            for link_name in self.links:
-                self.links[link_name].removeFromBuffer(message)
-            return False
-        else:       #Checking all other links' buffers
-            for link_name in self.links:
-                if link_name == message.linkName():
-                    continue
-                else:
-                    match = self.links[link_name].checkBuffer(message)
-                    if match:
-                        return True
-            return False
-
-        if match_count == 0:
-            return False
-        elif match_count == length(self.links):
-            for link_name in self.links:
-                self.links[link_name].removeFromBuffer(message)
-
-    def bufferMessage(self, message):
-        self.links[message.linkName()].addToBuffer(message)
-
-    def repeatSendLinkStatusMessage(self, message):
-        link_name = message.linkName()
-        self.links[link_name].sendLinkStatusMessage()
+        if message.name() != "DOWNLINK_STATUS":
+            (entry, new) = self.stream(message).arrival(message.linkName(), message.message(), time())
+            if not new:
+                return False
+            entry[ENTRY_FORWARDED] = True
+        IvySendMsg(message.message())
+        return True
+
+    def preferredLink(self, ac_id):
+        #The link with the best score among the ones of this aircraft, only replacing the current one if it is better by more than LINK_HYSTERESIS
+        candidates = [link for link in self.links.values() if ac_id in link.aircrafts()]
+        best = min(candidates, key=lambda link: link.score())
+        current = self.links.get(self.preferred_links.get(ac_id))
+        if current is None or ac_id not in current.aircrafts() or best.score() + LINK_HYSTERESIS < current.score():
+            current = best
+            self.preferred_links[ac_id] = best.name
+        return current.name
+
+    def selectMessage(self, message):
+        #Selection mode: the messages of the preferred link of the aircraft are forwarded as soon as they arrive, unless another link already forwarded them.
+        #A message first received by another link is held until the preferred link receives it too, or until the deadline, after which it is forwarded.
+        #The held messages are released when the next message arrives.
+
+        now = time()
+        (entry, new) = self.stream(message).arrival(message.linkName(), message.message(), now)
+        if entry is not None:
+            if message.linkName() == self.preferredLink(message.sender()):
+                if not entry[ENTRY_FORWARDED]:
+                    entry[ENTRY_FORWARDED] = True
+                    IvySendMsg(message.message())
+            elif new:
+                self.pending.append((now + LINK_DEADLINE, entry))
+        self.releasePending(now)
+
+    def releasePending(self, now):
+        #Called from onIvyMessage, with the lock held.
+        while self.pending and self.pending[0][0] <= now:
+            (deadline, entry) = self.pending.popleft()
+            if not entry[ENTRY_FORWARDED]:
+                entry[ENTRY_FORWARDED] = True
+                IvySendMsg(entry[ENTRY_CONTENTS])
+
+    def linkStatistics(self, link_name, ac_id=None, msg_name=None):
+        #The message counts of a link, over all the messages or the ones of an aircraft and/or a message name, and the loss, reorder and duplicate rates.
+        #A message is only counted as expected or lost once it can no longer be matched, see Message_Stream.
+
+        totals = [0] * 5
+        with self.lock:
+            for (key, stream) in self.streams.items():
+                if (ac_id is None or key[0] == ac_id) and (msg_name is None or key[1] == msg_name):
+                    counters = stream.counters.get(link_name)
+                    if counters is not None:
+                        totals = [t + c for (t, c) in zip(totals, counters)]
+        return {'received': totals[RECEIVED],
+                'expected': totals[EXPECTED],
+                'lost': totals[LOST],
+                'reordered': totals[REORDERED],
+                'duplicates': totals[DUPLICATES],
+                'loss_rate': float(totals[LOST]) / totals[EXPECTED] if totals[EXPECTED] else 0.,
+                'reorder_rate': float(totals[REORDERED]) / totals[RECEIVED] if totals[RECEIVED] else 0.,
+                'duplicate_rate': float(totals[DUPLICATES]) / (totals[RECEIVED] + totals[DUPLICATES]) if totals[RECEIVED] + totals[DUPLICATES] else 0.}
+
+    def sendLinkStatisticsMessage(self, link_name, ac_id):
+        stats = self.linkStatistics(link_name, ac_id)
+        IvySendMsg("link_combiner LINK_STATISTICS %s %s %i %i %i %i %i %f %f %f" % (
+            ac_id, link_name, stats['received'], stats['expected'], stats['lost'], stats['reordered'], stats['duplicates'],
+            stats['loss_rate'], stats['reorder_rate'], stats['duplicate_rate']))
+
+    def sendLinkStatusMessage(self, link_name, ac_id):
+        self.links[link_name].sendLinkStatusMessage(ac_id)
+        self.sendLinkStatisticsMessage(link_name, ac_id)
 
 
 
@@ -285,13 +461,25 @@ def main():
 
     #Command line options
     parser = argparse.ArgumentParser(description="Link_Combiner listens to the ivy messages received from multiple Link agents (set each of their -id options to a unique number), and sends a combined stream of messages to the other agents.")
-    parser.add_argument("-b", "-buffer_size", "--buffer_size", help="The number of elements messages to be stored in the circular buffer for each link", default=10)
+    parser.add_argument("-b", "-buffer_size", "--buffer_size", help="The number of messages of each name of each aircraft kept to match the copies of the links", default=32)
+    parser.add_argument("-w", "-window_time", "--window_time", help="The number of miliseconds a message is kept to match the copies of the links, 0 for no limit", default=1000)
+    parser.add_argument("-s", "-select", "--select", help="Forward the messages of the best link of each aircraft, the other links are only used when it misses a message", action="store_true")
+    parser.add_argument("-d", "-deadline", "--deadline", help="In selection mode, the number of miliseconds the other links wait for the best link before forwarding a message", default=200)
+    parser.add_argument("-y", "-hysteresis", "--hysteresis", help="In selection mode, the number of miliseconds of score by which a link must be better than the current one to replace it", default=100)
     parser.add_argument("-t", "-link_status_period", "--link_status_period", help="The number of miliseconds in between LINK_STATUS messages being sent to the GCS", default=1000)
     args = parser.parse_args()
 
     global BUFFER_SIZE
+    global WINDOW_TIME
+    global SELECT_LINK
+    global LINK_DEADLINE
+    global LINK_HYSTERESIS
     global LINK_STATUS_PERIOD
-    BUFFER_SIZE = int(args.buffer_size)            #The number of elements messages to be stored in the circular buffer for each link. 
+    BUFFER_SIZE = int(args.buffer_size)            #The number of messages of each name of each aircraft kept to match the copies of the links.
+    WINDOW_TIME = float(args.window_time)/1000     #The number of seconds a message is kept to match the copies of the links, 0 for no limit.
+    SELECT_LINK = args.select                      #Whether only the best link of each aircraft is forwarded.
+    LINK_DEADLINE = float(args.deadline)/1000      #The number of seconds the other links wait for the best link.
+    LINK_HYSTERESIS = float(args.hysteresis)/1000  #The number of seconds of score by which a link must be better to replace the current one.
     LINK_STATUS_PERIOD = float(args.link_status_period)/1000    #The number of seconds in between LINK_STATUS messages being sent to the GCS.
 
 
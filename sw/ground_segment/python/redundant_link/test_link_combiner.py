@@ -0,0 +1,67 @@
+import unittest
+from link_combiner import *
+
+class TestMessageStream(unittest.TestCase):
+
+    def test_copies(self):
+        """The copy received by another link is matched to the first arrival."""
+        stream = Message_Stream(10)
+        (entry, new) = stream.arrival('a', 'PING 1', 0.0)
+        self.assertTrue(new)
+        self.assertEqual(stream.arrival('b', 'PING 1', 0.01), (entry, False))
+        self.assertEqual(stream.counters['a'][RECEIVED], 1)
+        self.assertEqual(stream.counters['b'][RECEIVED], 1)
+        self.assertEqual(stream.counters['b'][DUPLICATES], 0)
+
+    def test_duplicates(self):
+        """A link repeating a message within part of the period is a duplicate."""
+        stream = Message_Stream(10)
+        for i in range(3):
+            stream.arrival('a', 'ATTITUDE %i' % i, float(i))
+        self.assertEqual(stream.arrival('a', 'ATTITUDE 2', 2.1), (None, False))
+        self.assertEqual(stream.counters['a'][DUPLICATES], 1)
+        self.assertEqual(stream.counters['a'][RECEIVED], 3)
+        # sent again by the aircraft a period later, it is a new message
+        (entry, new) = stream.arrival('a', 'ATTITUDE 2', 3.0)
+        self.assertTrue(new)
+        self.assertEqual(stream.counters['a'][DUPLICATES], 1)
+        # and the other link receives both
+        self.assertEqual(stream.arrival('b', 'ATTITUDE 2', 3.1)[1], False)
+        self.assertEqual(stream.arrival('b', 'ATTITUDE 2', 3.2), (entry, False))
+        self.assertEqual(stream.counters['b'][DUPLICATES], 0)
+
+    def test_reordered(self):
+        """A link receiving an older message after a newer one counts a reorder."""
+        stream = Message_Stream(10)
+        stream.arrival('a', 'GPS 1', 0.0)
+        stream.arrival('a', 'GPS 2', 1.0)
+        stream.arrival('b', 'GPS 2', 1.1)
+        stream.arrival('b', 'GPS 1', 1.2)
+        self.assertEqual(stream.counters['a'][REORDERED], 0)
+        self.assertEqual(stream.counters['b'][REORDERED], 1)
+        self.assertEqual(stream.counters['b'][RECEIVED], 2)
+
+    def test_lost(self):
+        """Evicted messages are expected from every link and lost by the ones which missed them."""
+        stream = Message_Stream(3)
+        for i in range(6):
+            stream.arrival('a', 'GPS %i' % i, float(i))
+            if i % 2 == 0:
+                stream.arrival('b', 'GPS %i' % i, i + 0.1)
+        # entries 0 to 2 were evicted, b only expects the entries created after it was first heard
+        self.assertEqual(stream.counters['a'][EXPECTED], 3)
+        self.assertEqual(stream.counters['a'][LOST], 0)
+        self.assertEqual(stream.counters['b'][EXPECTED], 2)
+        self.assertEqual(stream.counters['b'][LOST], 1)
+
+    def test_max_age(self):
+        """Entries older than max_age are no longer matched."""
+        stream = Message_Stream(10, 1.0)
+        (entry, new) = stream.arrival('a', 'GPS 1', 0.0)
+        (late, new) = stream.arrival('b', 'GPS 1', 2.0)
+        self.assertTrue(new)
+        self.assertFalse(late is entry)
+        self.assertEqual(stream.counters['a'][EXPECTED], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,12 +6,20 @@ import struct
 import os
 import logging
 import sys
-import threading
 import time
+import re
+import select
+import errno
+import heapq
+import collections
+import fcntl
+import multiprocessing
+from optparse import OptionParser
 
 sys.path.append(os.getenv("PAPARAZZI_HOME") + "/sw/lib/python")
 
 import messages_xml_map
+import pprz_checksum
 
 PING_PERIOD = 5.0
 STATUS_PERIOD = 1.0
@@ -22,27 +30,300 @@ STX_TS = 0x98
 DATALINK_PORT = 4243
 DOWNLINK_PORT = 4242
 
+# datalink frames waiting to be sent to one aircraft before the oldest are dropped
+UPLINK_QUEUE_SIZE = 64
+# time a datalink frame may wait for others to share its datagram, in seconds
+UPLINK_DELAY = 0.005
+# maximum size of a datagram packing several datalink frames, 0 sends one frame
+# per datagram (the W5100 firmware only parses the first frame of a datagram)
+UPLINK_MTU = 0
+# datagrams read from one socket before giving the other sockets and the timers a turn
+RX_BURST = 64
+# send times of the last pings, to find the one a pong answers
+PING_HISTORY = 4
+
+# start byte and length, timestamp of STX_TS frames, sender and message ids, checksum
+PPRZ_HEADER = struct.Struct('<BB')
+PPRZ_TIMESTAMP = struct.Struct('<L')
+PPRZ_IDS = struct.Struct('<BB')
+PPRZ_CHECKSUM = struct.Struct('<BB')
+# smallest frame: header, ids and checksum, without payload
+PPRZ_MIN_LENGTH = PPRZ_HEADER.size + PPRZ_IDS.size + PPRZ_CHECKSUM.size
+
 class DownLinkStatus():
-  def __init__(self, ac_id, address):
+  def __init__(self, ac_id, address, server, queue_size = UPLINK_QUEUE_SIZE):
       self.ac_id = ac_id
       self.address = address
+      self.server = server
+      # outbound datalink frames as [key, frame] entries, only touched by the
+      # event loop; entries with a key are replaced by newer frames of same key
+      self.uplink = collections.deque()
+      self.uplink_keys = {}
+      self.uplink_bytes = 0
+      self.uplink_deadline = None
+      self.uplink_size = queue_size
+      self.tx_frames = 0
+      self.tx_datagrams = 0
+      self.tx_collapsed = 0
+      self.tx_msgs = 0
+      self.tx_dropped = 0
+      self.tx_queue_max = 0
+      self.last_tx_dropped = 0
       self.rx_bytes = 0
       self.rx_msgs = 0
       self.run_time = 0
       self.last_rx_bytes = 0
       self.last_rx_msgs = 0
-      self.last_ping_time = 0
+      self.ping_times = collections.deque(maxlen = PING_HISTORY)
       self.last_pong_time = 0
 
-class IvyUdpLink():
-    def __init__(self):
-      self.InitIvy()
-      self.status_timer = threading.Timer(STATUS_PERIOD, self.sendStatus)
-      self.ping_timer = threading.Timer(STATUS_PERIOD, self.sendPing)
-      self.ac_downlink_status = { }
+  def pongReceived(self, pong_time):
+      # round trip of the last ping sent before the pong arrived
+      pings = [t for t in self.ping_times if t <= pong_time]
+      if pings:
+        self.last_pong_time = pong_time - max(pings)
+
+class DownlinkDecoder():
+    """Decodes telemetry datagrams and publishes them on the Ivy bus.
+
+    update_status(ac_id, length, address, server, isPong) is called for every
+    frame with a valid checksum.
+    """
+    def __init__(self, update_status, allowed_messages = None, forward_all = False):
+      self.update_status = update_status
+      # telemetry messages are only decoded when an agent on the bus is bound
+      # to them (or they are in allowed_messages), unless forward_all is set
+      self.allowed_messages = allowed_messages
+      self.forward_all = forward_all
+      self.remote_regexps = None
+      self.subscribed = {}
+      # set from the Ivy thread, the bindings are refreshed by the decoding thread
+      self.refresh_subscriptions = False
+      self.ivy_formats = {}
       self.rx_err = 0
-
       messages_xml_map.ParseMessages()
+
+    def OnIvyConnection(self, agent, event):
+      # bindings are only known once the agent is connected, look again
+      # before decoding the next packet
+      self.refresh_subscriptions = True
+      return event
+
+    def updateSubscriptions(self):
+      """Collect the regexps bound by the other agents on the bus."""
+      self.refresh_subscriptions = False
+      try:
+        regexps = set()
+        for name in IvyGetApplicationList():
+          client = IvyGetApplication(name)
+          for (idx, regexp) in IvyGetApplicationMessages(client):
+            regexps.add(regexp)
+      except Exception:
+        # bindings unknown, forward everything rather than losing messages
+        regexps = None
+      if regexps != self.remote_regexps:
+        self.remote_regexps = regexps
+        self.subscribed = {}
+
+    def isSubscribed(self, ac_id, msg_id):
+      """True if some agent may receive the message from this aircraft.
+
+      A message is subscribed when a bound regexp names it or matches a sample
+      of it with zero values, which errs on the side of forwarding.
+      """
+      key = (ac_id, msg_id)
+      subscribed = self.subscribed.get(key)
+      if subscribed is not None:
+        return subscribed
+      msg_name = messages_xml_map.message_dictionary_id_name["telemetry"][msg_id]
+      if self.forward_all:
+        subscribed = True
+      elif self.allowed_messages is not None and msg_name in self.allowed_messages:
+        subscribed = True
+      elif self.remote_regexps is None:
+        subscribed = self.allowed_messages is None
+      else:
+        field_count = len(messages_xml_map.message_dictionary_types["telemetry"][msg_id])
+        sample = " ".join(["%i %s" % (ac_id, msg_name)] + ["0"] * field_count)
+        subscribed = False
+        for regexp in self.remote_regexps:
+          try:
+            if msg_name in regexp or re.search(regexp, sample):
+              subscribed = True
+              break
+          except re.error:
+            subscribed = True
+            break
+      self.subscribed[key] = subscribed
+      return subscribed
+
+    def ivyFormat(self, msg_id):
+      """Format string of the Ivy message, precompiled once per message."""
+      ivy_format = self.ivy_formats.get(msg_id)
+      if ivy_format is None:
+        msg_name = messages_xml_map.message_dictionary_id_name["telemetry"][msg_id]
+        field_count = len(messages_xml_map.message_dictionary_types["telemetry"][msg_id])
+        ivy_format = " ".join(["%%i %s" % msg_name] + ["%s"] * field_count)
+        self.ivy_formats[msg_id] = ivy_format
+      return ivy_format
+
+    def ProcessPacket(self, msg, address, server = None):
+      if self.refresh_subscriptions:
+        self.updateSubscriptions()
+      if len(msg) < 4:
+        self.rx_err = self.rx_err + 1
+        return
+
+      # walk the frames of the datagram in place: memoryview slices and
+      # unpack_from offsets never copy the payload
+      buf = memoryview(msg)
+      buf_length = len(buf)
+      msg_offset = 0
+      while msg_offset < buf_length:
+        msg_start_idx = msg_offset
+        try:
+          (start_byte, msg_length) = PPRZ_HEADER.unpack_from(buf, msg_offset)
+          msg_offset += PPRZ_HEADER.size
+
+          if start_byte != STX and start_byte != STX_TS:
+            self.rx_err = self.rx_err + 1
+            return
+
+          min_length = PPRZ_MIN_LENGTH
+          if start_byte == STX_TS:
+            timestamp = PPRZ_TIMESTAMP.unpack_from(buf, msg_offset)[0]
+            msg_offset += PPRZ_TIMESTAMP.size
+            min_length += PPRZ_TIMESTAMP.size
+
+          # the length byte is trusted to skip payloads, reject impossible ones
+          if msg_length < min_length or msg_start_idx + msg_length > buf_length:
+            self.rx_err = self.rx_err + 1
+            return
+
+          (ac_id, msg_id) = PPRZ_IDS.unpack_from(buf, msg_offset)
+          msg_offset += PPRZ_IDS.size
+
+          if self.isSubscribed(ac_id, msg_id):
+            codec = messages_xml_map.message_dictionary_codecs["telemetry"][msg_id]
+            (values, msg_offset) = codec.unpack_from(buf, msg_offset)
+          else:
+            # nobody listens: skip the payload, the frame still counts in the status
+            values = None
+            msg_offset = msg_start_idx + msg_length - PPRZ_CHECKSUM.size
+
+          (msg_ck_a, msg_ck_b) = PPRZ_CHECKSUM.unpack_from(buf, msg_offset)
+          (ck_a, ck_b) = pprz_checksum.Checksum(buf, msg_start_idx + 1, msg_offset)
+        except (struct.error, KeyError):
+          print "finished without parsing frame at offset %i" % msg_start_idx
+          self.rx_err = self.rx_err + 1
+          return
+
+        msg_offset += PPRZ_CHECKSUM.size
+
+        # check for valid checksum
+        if (ck_a, ck_b) == (msg_ck_a, msg_ck_b):
+          self.update_status(ac_id, msg_length, address, server, msg_id == messages_xml_map.message_dictionary_name_id["telemetry"]["PONG"])
+
+          if values is not None:
+            for (idx, value) in enumerate(values):
+              if isinstance(value, tuple):
+                values[idx] = ",".join(map(str, value))
+            IvySendMsg(self.ivyFormat(msg_id) % tuple([ac_id] + values))
+        else:
+          self.rx_err = self.rx_err + 1
+
+class DecodeWorker(DownlinkDecoder):
+    """Decoding process of the --jobs mode.
+
+    Receives raw datagrams from the main process, publishes the decoded
+    messages on Ivy as its own agent and sends the per aircraft counters back
+    once per status period.
+    """
+    def __init__(self, index, datagrams, results, allowed_messages = None, forward_all = False):
+      DownlinkDecoder.__init__(self, self.updateStatus, allowed_messages, forward_all)
+      self.datagrams = datagrams
+      self.results = results
+      # ac_id -> [rx_msgs, rx_bytes, time of last pong]
+      self.counters = {}
+      IvyInit("Link decoder %i" % index, "READY", 0, self.OnIvyConnection, lambda x,y: y)
+      logging.getLogger('Ivy').setLevel(logging.WARN)
+      IvyStart("")
+
+    def updateStatus(self, ac_id, length, address, server, isPong):
+      counters = self.counters.get(ac_id)
+      if counters is None:
+        counters = self.counters[ac_id] = [0, 0, None]
+      counters[0] += 1
+      counters[1] += length
+      if isPong:
+        counters[2] = time.time()
+
+    def Run(self):
+      next_status = time.time() + STATUS_PERIOD
+      try:
+        while True:
+          if self.datagrams.poll(max(0, next_status - time.time())):
+            self.ProcessPacket(self.datagrams.recv_bytes(), None)
+          if time.time() >= next_status:
+            self.results.send((self.counters, self.rx_err))
+            self.counters = {}
+            self.rx_err = 0
+            self.updateSubscriptions()
+            next_status += STATUS_PERIOD
+      except (EOFError, IOError, KeyboardInterrupt):
+        # main process is gone
+        pass
+      IvyStop()
+
+def runDecodeWorker(index, datagrams, results, allowed_messages, forward_all, parent_ends):
+  # the forked copies of the main process ends would hide its exit (no EOF)
+  for connection in parent_ends:
+    connection.close()
+  DecodeWorker(index, datagrams, results, allowed_messages, forward_all).Run()
+
+class IvyUdpLink(DownlinkDecoder):
+    def __init__(self, allowed_messages = None, forward_all = False,
+                 downlink_ports = [DOWNLINK_PORT], datalink_port = DATALINK_PORT,
+                 queue_size = UPLINK_QUEUE_SIZE, uplink_delay = UPLINK_DELAY,
+                 uplink_mtu = UPLINK_MTU, link_id = 0, jobs = 1):
+      DownlinkDecoder.__init__(self, self.updateStatus, allowed_messages, forward_all)
+
+      # with jobs > 1, datagrams are decoded by worker processes sharded on
+      # ac_id so that each aircraft keeps its ordering; they must be forked
+      # before this process starts its Ivy threads, so a worker which dies is
+      # not restarted, its aircraft are moved to the others
+      self.workers = []
+      if jobs > 1:
+        for index in range(jobs):
+          (datagrams_r, datagrams_w) = multiprocessing.Pipe(False)
+          (results_r, results_w) = multiprocessing.Pipe(False)
+          parent_ends = [datagrams_w, results_r] + [end for worker in self.workers for end in worker[1:]]
+          worker = multiprocessing.Process(target = runDecodeWorker,
+              args = (index, datagrams_r, results_w, allowed_messages, forward_all, parent_ends))
+          worker.daemon = True
+          worker.start()
+          # only the worker uses these ends, keeping them open would hide its exit
+          datagrams_r.close()
+          results_w.close()
+          self.workers.append((worker, datagrams_w, results_r))
+
+      # everything below is owned by the event loop of Run(); the Ivy thread
+      # only appends to uplink_requests and wakes the loop up
+      self.downlink_ports = downlink_ports
+      self.datalink_port = datalink_port
+      self.queue_size = queue_size
+      self.uplink_delay = uplink_delay
+      self.uplink_mtu = uplink_mtu
+      self.link_id = link_id
+      self.servers = []
+      self.tasks = []
+      self.uplink_requests = collections.deque()
+      (self.wakeup_r, self.wakeup_w) = os.pipe()
+      for fd in (self.wakeup_r, self.wakeup_w):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+      self.ac_downlink_status = { }
+      self.InitIvy()
+
       self.data_types = { 'float' : ['f', 4],
                           'uint8' : ['B', 1],
                           'uint16' : ['H', 2],
@@ -52,15 +333,12 @@ class IvyUdpLink():
                           'int32' : ['l', 4]
                          }
 
-    def Unpack(self, data_fields, type, start, length):
-      return struct.unpack(type, "".join(data_fields[start:start + length]))[0]
-
     def InitIvy(self):
       # initialising the bus
       IvyInit("Link", # application name for Ivy
 			"READY",                 # ready message
 			0,                  # main loop is local (ie. using IvyMainloop)
-			lambda x,y: y,      # handler called on connection/deconnection
+			self.OnIvyConnection, # handler called on connection/deconnection
 			lambda x,y: y       # handler called when a diemessage is received
 			)
 
@@ -69,15 +347,6 @@ class IvyUdpLink():
       IvyStart("")
       IvyBindMsg(self.OnSettingMsg, "(^.* SETTING .*)")
 
-    def calculate_checksum(self, msg):
-      ck_a = 0
-      ck_b = 0
-      # start char not included in checksum for pprz protocol
-      for c in msg[1:]:
-	ck_a = (ck_a + ord(c)) % 256
-	ck_b = (ck_b + ck_a) % 256
-      return (ck_a, ck_b)
-
     def buildPprzMsg(self, msg_id, *args):
       stx = STX
       length = 6
@@ -95,139 +364,286 @@ class IvyUdpLink():
 	  typed_args.append(int(args[idx]))
 	idx += 1
       msg = struct.pack(struct_string, stx, length, sender, msg_id, *typed_args)
-      (ck_a, ck_b) = self.calculate_checksum(msg)
+      # start char not included in checksum for pprz protocol
+      (ck_a, ck_b) = pprz_checksum.Checksum(msg, 1)
       msg = msg + struct.pack('=BB', ck_a, ck_b)
       return msg
       
     def OnSettingMsg(self, agent, *larg):
+      # called from the Ivy thread: hand the frame over to the event loop
       list = larg[0].split(' ')
       sender = list[0]
       msg_name = list[1]
       ac_id = list[3]
       args = list[2:]
       msg_id = messages_xml_map.message_dictionary_name_id["datalink"][msg_name]
-      if self.ac_downlink_status.has_key(int(ac_id)):
-	msgbuf = self.buildPprzMsg(msg_id, *args)
-	address = (self.ac_downlink_status[int(ac_id)].address[0], DATALINK_PORT)
-	self.server.sendto(msgbuf, address)
+      msgbuf = self.buildPprzMsg(msg_id, *args)
+      # only the last value of a setting matters, pending ones can be replaced
+      self.uplink_requests.append((int(ac_id), msgbuf, (msg_id, list[2])))
+      try:
+        os.write(self.wakeup_w, 'x')
+      except OSError:
+        pass
+
+    def queueUplink(self, ac_id, msgbuf, key = None):
+      if not self.ac_downlink_status.has_key(ac_id):
+        return
+      status = self.ac_downlink_status[ac_id]
+      status.tx_frames += 1
+      if key is not None and key in status.uplink_keys:
+        entry = status.uplink_keys[key]
+        status.uplink_bytes += len(msgbuf) - len(entry[1])
+        entry[1] = msgbuf
+        status.tx_collapsed += 1
+        return
+      if len(status.uplink) >= status.uplink_size:
+        # the radio can't keep up, the oldest frame is the least relevant one
+        (old_key, old_msgbuf) = status.uplink.popleft()
+        status.uplink_keys.pop(old_key, None)
+        status.uplink_bytes -= len(old_msgbuf)
+        status.tx_dropped += 1
+      entry = [key, msgbuf]
+      status.uplink.append(entry)
+      if key is not None:
+        status.uplink_keys[key] = entry
+      status.uplink_bytes += len(msgbuf)
+      status.tx_queue_max = max(status.tx_queue_max, len(status.uplink))
+      if status.uplink_deadline is None:
+        status.uplink_deadline = time.time() + self.uplink_delay
+
+    def uplinkDue(self, status, now):
+      return status.uplink and (now >= status.uplink_deadline or
+                                (self.uplink_mtu > 0 and status.uplink_bytes >= self.uplink_mtu))
+
+    def flushUplink(self, status):
+      address = (status.address[0], self.datalink_port)
+      while status.uplink:
+        # pack as many frames as the mtu allows, always at least one
+        count = 1
+        size = len(status.uplink[0][1])
+        while count < len(status.uplink) and size + len(status.uplink[count][1]) <= self.uplink_mtu:
+          size += len(status.uplink[count][1])
+          count += 1
+        datagram = "".join([status.uplink[i][1] for i in range(count)])
+        try:
+          status.server.sendto(datagram, address)
+        except socket.error as e:
+          if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+            # socket buffer full, retry when select reports it writable
+            return
+          logging.getLogger('Link').warning("uplink to %s failed: %s", address[0], e)
+        for i in range(count):
+          (key, msgbuf) = status.uplink.popleft()
+          status.uplink_keys.pop(key, None)
+          status.uplink_bytes -= len(msgbuf)
+        status.tx_msgs += count
+        status.tx_datagrams += 1
+      status.uplink_deadline = None
 
     def sendPing(self):
+      msg_id = messages_xml_map.message_dictionary_name_id["datalink"]["PING"]
+      msgbuf = self.buildPprzMsg(msg_id)
       for (ac_id, value) in self.ac_downlink_status.items():
-	msg_id = messages_xml_map.message_dictionary_name_id["datalink"]["PING"]
-	msgbuf = self.buildPprzMsg(msg_id)
-	address = (self.ac_downlink_status[int(ac_id)].address[0], DATALINK_PORT)
-	self.server.sendto(msgbuf, address)
-	value.last_ping_time = time.clock()
-      
-      self.ping_timer = threading.Timer(STATUS_PERIOD, self.sendPing)
-      self.ping_timer.start()
+        self.queueUplink(ac_id, msgbuf)
+        value.ping_times.append(time.time())
 
     def sendStatus(self):
       for (key, value) in self.ac_downlink_status.items():
-	IvySendMsg("%i DOWNLINK_STATUS %i %i %i %i %i %i %i" % (
-	  value.ac_id,
-	  value.run_time,
-	  value.rx_bytes,
-	  value.rx_msgs,
-	  self.rx_err,
-	  value.rx_bytes - value.last_rx_bytes,
-	  value.rx_msgs - value.last_rx_msgs,
-	  1000 * value.last_pong_time ))
-	value.last_rx_bytes = value.rx_bytes
-	value.last_rx_msgs = value.rx_msgs
-	value.run_time = value.run_time + 1
-
-      self.status_timer = threading.Timer(STATUS_PERIOD, self.sendStatus)
-      self.status_timer.start()
-
-    def updateStatus(self, ac_id, length, address, isPong):
+        if value.tx_datagrams > 0:
+          uplink_ratio = float(value.tx_frames - len(value.uplink)) / value.tx_datagrams
+        else:
+          uplink_ratio = 0.
+        IvySendMsg("%i DOWNLINK_STATUS %i %i %i %i %i %i %i %i %.2f" % (
+          value.ac_id,
+          self.link_id,
+          value.run_time,
+          value.rx_bytes,
+          value.rx_msgs,
+          self.rx_err,
+          value.rx_bytes - value.last_rx_bytes,
+          value.rx_msgs - value.last_rx_msgs,
+          1000 * value.last_pong_time,
+          uplink_ratio ))
+        if value.tx_dropped != value.last_tx_dropped:
+          logging.getLogger('Link').warning("aircraft %i: dropped %i uplink frames (%i total, max queue %i)",
+              value.ac_id, value.tx_dropped - value.last_tx_dropped, value.tx_dropped, value.tx_queue_max)
+        value.last_rx_bytes = value.rx_bytes
+        value.last_rx_msgs = value.rx_msgs
+        value.last_tx_dropped = value.tx_dropped
+        value.run_time = value.run_time + 1
+
+      self.updateSubscriptions()
+
+    def getStatus(self, ac_id, address, server):
       if not self.ac_downlink_status.has_key(ac_id):
-	self.ac_downlink_status[ac_id] = DownLinkStatus(ac_id, address)
+        self.ac_downlink_status[ac_id] = DownLinkStatus(ac_id, address, server, self.queue_size)
+      return self.ac_downlink_status[ac_id]
 
+    def updateStatus(self, ac_id, length, address, server, isPong):
+      self.getStatus(ac_id, address, server)
       self.ac_downlink_status[ac_id].rx_msgs += 1
       self.ac_downlink_status[ac_id].rx_bytes += length
       if isPong:
-	self.ac_downlink_status[ac_id].last_pong_time = time.clock() - self.ac_downlink_status[ac_id].last_ping_time 
-
-    def ProcessPacket(self, msg, address):
-      if len(msg) < 4:
+        self.ac_downlink_status[ac_id].pongReceived(time.time())
+
+    def addTask(self, period, callback):
+      heapq.heappush(self.tasks, (time.time() + period, period, callback))
+
+    def runTasks(self):
+      now = time.time()
+      while self.tasks and self.tasks[0][0] <= now:
+        (deadline, period, callback) = heapq.heappop(self.tasks)
+        callback()
+        # keep the period without drifting, but don't try to catch up after a stall
+        heapq.heappush(self.tasks, (max(deadline + period, now), period, callback))
+
+    def receive(self, server):
+      for i in range(RX_BURST):
+        try:
+          (msg, address) = server.recvfrom(2048)
+        except socket.error as e:
+          if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return
+          raise
+        if self.workers:
+          self.dispatchPacket(msg, address, server)
+        else:
+          self.ProcessPacket(msg, address, server)
+
+    def dispatchPacket(self, msg, address, server):
+      # route on the sender of the first frame so that one aircraft always
+      # goes to the same worker, in order
+      try:
+        start_byte = PPRZ_HEADER.unpack_from(msg, 0)[0]
+        ids_offset = PPRZ_HEADER.size
+        if start_byte == STX_TS:
+          ids_offset += PPRZ_TIMESTAMP.size
+        ac_id = PPRZ_IDS.unpack_from(msg, ids_offset)[0]
+      except struct.error:
         self.rx_err = self.rx_err + 1
         return
-
-      msg_offset = 0
-      while msg_offset < len(msg):
-	start_byte = ord(msg[msg_offset])
-	msg_start_idx = msg_offset
-	msg_offset = msg_offset + 1
-
-	if start_byte != STX and start_byte != STX_TS:
-	  self.rx_err = self.rx_err + 1
-	  return
-
-	msg_length = ord(msg[msg_offset])
-	msg_offset = msg_offset + 1
-
-	if (start_byte == STX_TS):
-	  timestamp = int(self.Unpack(msg, 'L', msg_offset, 4))
-	  msg_offset = msg_offset + 4
-
-	ac_id = ord(msg[msg_offset])
-	msg_offset = msg_offset + 1
-
-        msg_id = ord(msg[msg_offset])
-        msg_offset = msg_offset + 1
-      
-        msg_name = messages_xml_map.message_dictionary_id_name["telemetry"][msg_id]
-        msg_fields = messages_xml_map.message_dictionary_types["telemetry"][msg_id]
-
-        ivy_msg = "%i %s " % (ac_id, msg_name)
-
-        for field in msg_fields:
-	  if field[-2:] == "[]":
-	    baseType = field[:-2]
-	    array_length = int(self.Unpack(msg, 'B', msg_offset, 1))
-	    msg_offset = msg_offset + 1
-	    for count in range(0, array_length):
-	      array_value = str(self.Unpack(msg, self.data_types[baseType][0], msg_offset, self.data_types[baseType][1]))
-	      msg_offset = msg_offset + self.data_types[baseType][1]
-	      if (count == array_length - 1):
-		ivy_msg += array_value + " "
-	      else:
-		ivy_msg += array_value + ","
-	  else:
-	    ivy_msg += str(self.Unpack(msg, self.data_types[field][0], msg_offset, self.data_types[field][1])) + " "
-	    msg_offset = msg_offset + self.data_types[field][1]
-
-	  if (msg_offset > len(msg)):
-	    print "finished without parsing %s" % field
-	    break
-
-	(ck_a, ck_b) = self.calculate_checksum(msg[msg_start_idx:msg_offset])
-	msg_ck_a = int(self.Unpack(msg, 'B', msg_offset, 1))
-	msg_offset += 1
-	msg_ck_b = int(self.Unpack(msg, 'B', msg_offset, 1))
-	msg_offset += 1
-
-	# check for valid checksum
-	if (ck_a, ck_b) == (msg_ck_a, msg_ck_b):
-	  self.updateStatus(ac_id, msg_length, address, msg_id == messages_xml_map.message_dictionary_name_id["telemetry"]["PONG"])
-
-	  # strip off trailing whitespace
-	  ivy_msg = ivy_msg[:-1]
-	  IvySendMsg(ivy_msg)
+      if start_byte != STX and start_byte != STX_TS:
+        self.rx_err = self.rx_err + 1
+        return
+      # known here so that datalink and pings can be sent before the first stats
+      self.getStatus(ac_id, address, server)
+      while self.workers:
+        worker = self.workers[ac_id % len(self.workers)]
+        try:
+          worker[1].send_bytes(msg)
+          return
+        except (IOError, OSError):
+          self.dropWorker(worker)
+      # no worker left, decode here
+      self.ProcessPacket(msg, address, server)
+
+    def dropWorker(self, worker):
+      logging.getLogger('Link').warning("decoding worker %i exited, its aircraft are moved to the %i other workers",
+          worker[0].pid, len(self.workers) - 1)
+      self.workers.remove(worker)
+      for connection in worker[1:]:
+        connection.close()
+
+    def mergeResults(self, worker):
+      try:
+        (counters, rx_err) = worker[2].recv()
+      except (EOFError, IOError, OSError):
+        self.dropWorker(worker)
+        return
+      self.rx_err = self.rx_err + rx_err
+      for (ac_id, (rx_msgs, rx_bytes, pong_time)) in counters.items():
+        status = self.ac_downlink_status.get(ac_id)
+        if status is None:
+          continue
+        status.rx_msgs += rx_msgs
+        status.rx_bytes += rx_bytes
+        if pong_time is not None:
+          status.pongReceived(pong_time)
 
     def Run(self):
-      self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-      self.server.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-      self.server.bind(('0.0.0.0' , DOWNLINK_PORT))
-      self.status_timer.start()
-      self.ping_timer.start()
+      for port in self.downlink_ports:
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        server.bind(('0.0.0.0' , port))
+        server.setblocking(0)
+        self.servers.append(server)
+      self.addTask(STATUS_PERIOD, self.sendStatus)
+      self.addTask(STATUS_PERIOD, self.sendPing)
+
+      # single threaded event loop: datagrams, uplink queues and periodic tasks
       while True:
-        (msg, address) = self.server.recvfrom(2048)
-        self.ProcessPacket(msg, address)
+        now = time.time()
+        deadline = self.tasks[0][0]
+        pending = set()
+        for status in self.ac_downlink_status.values():
+          if self.uplinkDue(status, now):
+            pending.add(status.server)
+          elif status.uplink:
+            deadline = min(deadline, status.uplink_deadline)
+        timeout = max(0, deadline - now)
+        results = [worker[2] for worker in self.workers]
+        try:
+          (readable, writable, errors) = select.select(self.servers + results + [self.wakeup_r], list(pending), [], timeout)
+        except select.error as e:
+          if e.args[0] == errno.EINTR:
+            continue
+          raise
+
+        if self.wakeup_r in readable:
+          try:
+            os.read(self.wakeup_r, 4096)
+          except OSError:
+            pass
+        while self.uplink_requests:
+          (ac_id, msgbuf, key) = self.uplink_requests.popleft()
+          self.queueUplink(ac_id, msgbuf, key)
+
+        for server in self.servers:
+          if server in readable:
+            self.receive(server)
+
+        for worker in list(self.workers):
+          if worker[2] in readable:
+            self.mergeResults(worker)
+
+        self.runTasks()
+
+        now = time.time()
+        for status in self.ac_downlink_status.values():
+          if self.uplinkDue(status, now):
+            self.flushUplink(status)
 
 def main():
-  udp_interface = IvyUdpLink()
+  parser = OptionParser()
+  parser.add_option("-m", "--messages", dest="messages",
+                    help="comma separated telemetry messages to always forward, only these are forwarded when the bindings of the other agents are unknown")
+  parser.add_option("-a", "--all", dest="forward_all", action="store_true", default=False,
+                    help="decode and forward every telemetry message, even when no agent is bound to it")
+  parser.add_option("-p", "--ports", dest="ports", default=str(DOWNLINK_PORT),
+                    help="comma separated local UDP ports to receive telemetry on")
+  parser.add_option("-d", "--datalink_port", dest="datalink_port", type="int", default=DATALINK_PORT,
+                    help="UDP port of the aircraft to send datalink messages to")
+  parser.add_option("-q", "--queue_size", dest="queue_size", type="int", default=UPLINK_QUEUE_SIZE,
+                    help="maximum number of datalink frames queued per aircraft")
+  parser.add_option("-u", "--uplink_delay", dest="uplink_delay", type="float", default=1000 * UPLINK_DELAY,
+                    help="milliseconds a datalink frame waits for newer values or other frames to share its datagram")
+  parser.add_option("-t", "--mtu", dest="mtu", type="int", default=UPLINK_MTU,
+                    help="maximum size of a datagram packing several datalink frames, 0 sends one frame per datagram")
+  parser.add_option("-i", "--id", dest="link_id", type="int", default=0,
+                    help="link id reported in DOWNLINK_STATUS")
+  parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                    help="number of processes decoding telemetry, aircraft are spread over them by id")
+  (options, args) = parser.parse_args()
+
+  allowed_messages = None
+  if options.messages:
+    allowed_messages = set(options.messages.split(','))
+
+  downlink_ports = [int(port) for port in options.ports.split(',')]
+  udp_interface = IvyUdpLink(allowed_messages, options.forward_all,
+                             downlink_ports, options.datalink_port, options.queue_size,
+                             options.uplink_delay / 1000., options.mtu, options.link_id,
+                             options.jobs)
   udp_interface.Run()
 
 if __name__ == '__main__':
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, print_function
+
+# Random access to the .data telemetry logs written by the server.
+#
+# A .data log has one message per line: timestamp, ac_id, message name and
+# the values, separated by spaces. The log is cut in blocks of about
+# BLOCK_SIZE bytes on line boundaries and the index keeps, for every
+# (ac_id, message) present in a block, the byte span from its first to its
+# last line together with the time range and count of these lines. Queries
+# only read the spans of the blocks holding the wanted message and times.
+#
+# The index is built on first use and saved next to the log (log.data.idx)
+# so that further runs on the same log skip the full scan.
+#
+# ReadMessage converts all the lines of a message at once into a numpy
+# structured array named after the fields of messages.xml: the lines of the
+# message are picked out of each span, stripped of their ac_id and name and
+# parsed by a single numpy.fromstring.
+
+import os
+import sys
+import getopt
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import messages_xml_map
+
+# bump when the layout of the index changes
+INDEX_VERSION = 1
+INDEX_PROTOCOL = 2
+INDEX_SUFFIX = '.idx'
+
+# granularity of the index, in bytes of log
+BLOCK_SIZE = 256 << 10
+
+# amount of spans read at once by ReadMessageChunks, in bytes of log
+CHUNK_SIZE = 16 << 20
+
+# column of the log timestamp in the arrays of ReadMessage, some messages
+# have a timestamp field of their own
+TIME_FIELD = 'log_time'
+
+# numpy types of the scalar pprz types, values are logged as text so the
+# floats are kept with double precision
+NUMPY_TYPES = { 'float' : 'f8',
+                'double' : 'f8',
+                'uint8' : 'u1',
+                'uint16' : 'u2',
+                'uint32' : 'u4',
+                'uint64' : 'u8',
+                'int8' : 'i1',
+                'int16' : 'i2',
+                'int32' : 'i4',
+                'int64' : 'i8'
+              }
+
+def _native(field):
+    # fields are read as bytes, keep the index keys as native strings
+    if isinstance(field, str):
+        return field
+    return field.decode('ascii', 'replace')
+
+def MessageDtype(msg_name, class_name = 'telemetry'):
+    """numpy dtype of the arrays of msg_name: TIME_FIELD then its fields.
+
+    Raises ValueError for messages with array or string fields.
+    """
+    messages_xml_map.ParseMessages()
+    field_names = messages_xml_map.message_dictionary[class_name][msg_name]
+    msg_id = messages_xml_map.message_dictionary_name_id[class_name][msg_name]
+    field_types = messages_xml_map.message_dictionary_types[class_name][msg_id]
+    dtype = [(TIME_FIELD, 'f8')]
+    for (name, field_type) in zip(field_names, field_types):
+        if field_type not in NUMPY_TYPES:
+            raise ValueError("field %s of %s is not numeric (%s)" % (name, msg_name, field_type))
+        dtype.append((name, NUMPY_TYPES[field_type]))
+    return numpy.dtype(dtype)
+
+class LogReader:
+    """Indexed reader of a .data log.
+
+    ac_ids lists the aircraft ids in order of appearance (as strings) and
+    spans maps (ac_id, msg_name) to the list of (start, end, t_min, t_max,
+    count) spans of its lines, in file order.
+    """
+    def __init__(self, filename, use_cache = True):
+        self.filename = filename
+        self.index_path = filename + INDEX_SUFFIX
+        self.ac_ids = []
+        self.spans = {}
+        self.key = self.IndexKey()
+        if not (use_cache and self.LoadIndex(self.key)):
+            self.BuildIndex()
+            if use_cache:
+                self.SaveIndex(self.key)
+
+    def IndexKey(self):
+        # python 2 and 3 pickle strings differently, rebuild when switching
+        st = os.stat(self.filename)
+        return (INDEX_VERSION, sys.version_info[0], BLOCK_SIZE, st.st_size, st.st_mtime)
+
+    def LoadIndex(self, key):
+        try:
+            with open(self.index_path, 'rb') as f:
+                index = pickle.load(f)
+        except Exception:
+            return False
+        if index.get('key') != key:
+            return False
+        self.ac_ids = index['ac_ids']
+        self.spans = index['spans']
+        return True
+
+    def SaveIndex(self, key):
+        index = { 'key' : key,
+                  'ac_ids' : self.ac_ids,
+                  'spans' : self.spans }
+        tmp_path = '%s.%i' % (self.index_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(index, f, INDEX_PROTOCOL)
+            os.rename(tmp_path, self.index_path)
+        except (IOError, OSError):
+            # the index is only an optimisation, logs in read-only places still work
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def BuildIndex(self):
+        ac_ids = []
+        spans = {}
+        offset = 0
+        with open(self.filename, 'rb') as f:
+            while True:
+                block = f.read(BLOCK_SIZE)
+                if not block:
+                    break
+                # complete the last line so that blocks end on line boundaries
+                block += f.readline()
+                # (ac_id, msg_name) fields -> [start, end, t_min, t_max, count]
+                block_spans = {}
+                for line in block.splitlines(True):
+                    start = offset
+                    offset += len(line)
+                    fields = line.split(None, 3)
+                    if len(fields) < 3:
+                        continue
+                    try:
+                        timestamp = float(fields[0])
+                    except ValueError:
+                        continue
+                    key = (fields[1], fields[2])
+                    span = block_spans.get(key)
+                    if span is None:
+                        block_spans[key] = [start, offset, timestamp, timestamp, 1]
+                        ac_id = _native(fields[1])
+                        if ac_id not in ac_ids:
+                            ac_ids.append(ac_id)
+                    else:
+                        span[1] = offset
+                        if timestamp < span[2]:
+                            span[2] = timestamp
+                        if timestamp > span[3]:
+                            span[3] = timestamp
+                        span[4] += 1
+                for ((ac_id, msg_name), span) in block_spans.items():
+                    spans.setdefault((_native(ac_id), _native(msg_name)), []).append(tuple(span))
+        self.ac_ids = ac_ids
+        self.spans = spans
+
+    def GetIds(self):
+        """Aircraft ids found in the log, in order of appearance."""
+        return list(self.ac_ids)
+
+    def GetMessages(self, ac_id):
+        """Names of the messages logged for ac_id."""
+        ac_id = str(ac_id)
+        return sorted(msg_name for (key_id, msg_name) in self.spans if key_id == ac_id)
+
+    def Count(self, ac_id, msg_name):
+        """Number of msg_name lines of ac_id in the log."""
+        return sum(span[4] for span in self.spans.get((str(ac_id), msg_name), []))
+
+    def TimeRange(self, ac_id, msg_name):
+        """(first, last) timestamps of msg_name for ac_id, None if absent."""
+        key_spans = self.spans.get((str(ac_id), msg_name))
+        if not key_spans:
+            return None
+        return (min(span[2] for span in key_spans), max(span[3] for span in key_spans))
+
+    def Spans(self, ac_id, msg_name, t_min = None, t_max = None):
+        """Spans of msg_name for ac_id overlapping [t_min, t_max]."""
+        return [span for span in self.spans.get((str(ac_id), msg_name), [])
+                if not ((t_min is not None and span[3] < t_min) or (t_max is not None and span[2] > t_max))]
+
+    def Lines(self, ac_id, msg_name, t_min = None, t_max = None):
+        """Yield (timestamp, values) of the msg_name lines of ac_id.
+
+        values is the list of the raw value fields of the line. Only the
+        lines with t_min <= timestamp <= t_max are returned when the bounds
+        are given, the spans outside of the time range are not read.
+        """
+        ac_field = str(ac_id).encode('ascii')
+        name_field = msg_name.encode('ascii')
+        with open(self.filename, 'rb') as f:
+            for (start, end, span_min, span_max, count) in self.Spans(ac_id, msg_name, t_min, t_max):
+                f.seek(start)
+                for line in f.read(end - start).splitlines():
+                    fields = line.split(None, 3)
+                    if len(fields) < 3 or fields[2] != name_field or fields[1] != ac_field:
+                        continue
+                    timestamp = float(fields[0])
+                    if (t_min is not None and timestamp < t_min) or (t_max is not None and timestamp > t_max):
+                        continue
+                    if len(fields) > 3:
+                        yield (timestamp, fields[3].split())
+                    else:
+                        yield (timestamp, [])
+
+    def ReadMessage(self, ac_id, msg_name, t_min = None, t_max = None):
+        """Return the msg_name lines of ac_id as a numpy structured array.
+
+        The array has a TIME_FIELD column followed by the fields of the
+        message in messages.xml, so columns are accessed by name, e.g.
+        ReadMessage(5, 'IMU_MAG_RAW')['mx']. Lines which do not have the
+        expected number of numeric values are skipped.
+        """
+        return self.ReadSpans(ac_id, msg_name, self.Spans(ac_id, msg_name, t_min, t_max), t_min, t_max)
+
+    def ReadMessageChunks(self, ac_id, msg_name, t_min = None, t_max = None, chunk_size = CHUNK_SIZE):
+        """Yield the ReadMessage array of msg_name in successive parts.
+
+        Each part covers about chunk_size bytes of log, so that long logs
+        can be processed in constant memory.
+        """
+        spans = []
+        size = 0
+        for span in self.Spans(ac_id, msg_name, t_min, t_max):
+            spans.append(span)
+            size += span[1] - span[0]
+            if size >= chunk_size:
+                yield self.ReadSpans(ac_id, msg_name, spans, t_min, t_max)
+                spans = []
+                size = 0
+        if spans:
+            yield self.ReadSpans(ac_id, msg_name, spans, t_min, t_max)
+
+    def ReadSpans(self, ac_id, msg_name, spans, t_min = None, t_max = None):
+        if numpy is None:
+            raise ImportError("numpy is required to read messages as arrays")
+        dtype = MessageDtype(msg_name)
+        columns = len(dtype.names)
+        # the marker directly follows the timestamp of the lines of the message
+        marker = (' %s %s ' % (ac_id, msg_name)).encode('ascii')
+        blocks = []
+        nb_lines = 0
+        with open(self.filename, 'rb') as f:
+            for (start, end, span_min, span_max, count) in spans:
+                f.seek(start)
+                # pad the lines so that messages without fields match the marker too
+                data = f.read(end - start).replace(b'\n', b' \n')
+                lines = [line for line in data.splitlines() if line.find(marker) == line.find(b' ') >= 0]
+                nb_lines += len(lines)
+                # keep only timestamp and values
+                blocks.append(b'\n'.join(lines).replace(marker, b' '))
+        text = _native(b'\n'.join(blocks))
+        values = numpy.fromstring(text, dtype = numpy.float64, sep = ' ') if nb_lines else numpy.zeros(0)
+        if values.size == nb_lines * columns:
+            table = values.reshape((nb_lines, columns))
+        else:
+            # malformed lines, sort them out one by one
+            rows = []
+            for line in text.splitlines():
+                try:
+                    row = [float(v) for v in line.split()]
+                except ValueError:
+                    continue
+                if len(row) == columns:
+                    rows.append(row)
+            table = numpy.array(rows, dtype = numpy.float64).reshape((len(rows), columns))
+        if t_min is not None:
+            table = table[table[:, 0] >= t_min]
+        if t_max is not None:
+            table = table[table[:, 0] <= t_max]
+        data = numpy.empty(len(table), dtype = dtype)
+        for (i, name) in enumerate(dtype.names):
+            data[name] = table[:, i]
+        return data
+
+    def ReadMessages(self, ac_id, msg_names = None, t_min = None, t_max = None):
+        """Return a dictionary of msg_name to ReadMessage array for ac_id.
+
+        All the numeric messages of ac_id are read if msg_names is None.
+        """
+        messages = {}
+        if msg_names is None:
+            msg_names = self.GetMessages(ac_id)
+            for msg_name in msg_names:
+                try:
+                    messages[msg_name] = self.ReadMessage(ac_id, msg_name, t_min, t_max)
+                except (KeyError, ValueError):
+                    pass
+        else:
+            for msg_name in msg_names:
+                messages[msg_name] = self.ReadMessage(ac_id, msg_name, t_min, t_max)
+        return messages
+
+# readers of the logs opened by this process, by path
+open_logs = {}
+
+def OpenLog(filename, use_cache = True):
+    """Return the LogReader of filename, shared by all callers of the process.
+
+    The reader is reopened if the log changed since it was indexed.
+    """
+    path = os.path.abspath(filename)
+    reader = open_logs.get(path)
+    if reader is None or reader.key != reader.IndexKey():
+        reader = LogReader(path, use_cache)
+        open_logs[path] = reader
+    return reader
+
+def Usage(scmd):
+    lpathitem = scmd.split('/')
+    fmt = '''Usage: %s [-h | --help] [-f | --force] log_filename.data
+where
+\t-h | --help print this message
+\t-f | --force rebuild the index even if it is up to date
+'''
+    print(fmt % lpathitem[-1])
+
+def main():
+    try:
+        optlist, left_args = getopt.getopt(sys.argv[1:], 'hf', ['help', 'force'])
+    except getopt.GetoptError:
+        Usage(sys.argv[0])
+        sys.exit(2)
+    force = False
+    for o, a in optlist:
+        if o in ("-h", "--help"):
+            Usage(sys.argv[0])
+            sys.exit()
+        elif o in ("-f", "--force"):
+            force = True
+    if len(left_args) != 1:
+        Usage(sys.argv[0])
+        sys.exit(2)
+    if force and os.path.exists(left_args[0] + INDEX_SUFFIX):
+        os.remove(left_args[0] + INDEX_SUFFIX)
+    reader = LogReader(left_args[0])
+    for ac_id in reader.GetIds():
+        for msg_name in reader.GetMessages(ac_id):
+            (t_min, t_max) = reader.TimeRange(ac_id, msg_name)
+            print("%s %s: %i messages from %.3f to %.3f" % (ac_id, msg_name, reader.Count(ac_id, msg_name), t_min, t_max))
+
+if __name__ == '__main__':
+    main()
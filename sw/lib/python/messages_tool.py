@@ -23,9 +23,10 @@ class Aircraft:
         self.messages_book = None
 
 class IvyMessagesInterface():
-    def __init__(self, callback, initIvy = True):
+    def __init__(self, callback, initIvy = True, regex = "(.*)"):
         self.callback = callback
         self.ivy_id = 0
+        self.regex = regex
         self.InitIvy(initIvy)
 
     def Stop(self):
@@ -46,7 +47,7 @@ class IvyMessagesInterface():
             IvyInit("Messages %i" % os.getpid(), "READY", 0, lambda x,y: y, lambda x,y: y)
             logging.getLogger('Ivy').setLevel(logging.WARN)
             IvyStart("")
-        self.ivy_id = IvyBindMsg(self.OnIvyMsg, "(.*)")
+        self.ivy_id = IvyBindMsg(self.OnIvyMsg, self.regex)
 
     def OnIvyMsg(self, agent, *larg):
         data = larg[0].split(' ')
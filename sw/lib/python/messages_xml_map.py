@@ -5,13 +5,106 @@ from __future__ import absolute_import, print_function
 import os
 import sys
 import getopt
+import struct
+import hashlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 messages_path = '%s/conf/messages.xml' % os.getenv("PAPARAZZI_HOME")
+cache_dir = '%s/var' % os.getenv("PAPARAZZI_HOME")
+
+# bump when the layout of the cached dictionaries changes
+CACHE_VERSION = 1
+CACHE_PROTOCOL = 2
+
+# path of the messages.xml currently loaded in the dictionaries
+parsed_path = None
 
 message_dictionary = {}
 message_dictionary_types = {}
 message_dictionary_id_name = {}
 message_dictionary_name_id = {}
+message_dictionary_codecs = {}
+
+# struct format characters of the pprz binary types (little endian, standard sizes)
+data_types = { 'float' : 'f',
+               'double' : 'd',
+               'uint8' : 'B',
+               'uint16' : 'H',
+               'uint32' : 'L',
+               'uint64' : 'Q',
+               'int8' : 'b',
+               'int16' : 'h',
+               'int32' : 'l',
+               'int64' : 'q'
+             }
+
+class MessageCodec:
+    """Precompiled decoder for the binary payload of one message.
+
+    Messages with only scalar fields are decoded by a single struct.Struct.
+    Messages with variable length arrays (``type[]``) get a decode plan made
+    of fixed size struct.Struct runs separated by length-prefixed arrays.
+    Decoded values are returned in field order, arrays as tuples. Messages
+    with a field of another type are not supported, unpack_from raises
+    KeyError for them.
+    """
+    def __init__(self, field_types):
+        self.field_types = field_types
+        self.supported = True
+        self.unsupported_type = None
+        self.struct = None
+        self.size = None
+        self.plan = []
+        run = ''
+        for field in field_types:
+            if field[-2:] == "[]":
+                if field[:-2] not in data_types:
+                    self.supported = False
+                    self.unsupported_type = field
+                    return
+                if run:
+                    self.plan.append((struct.Struct('<' + run), None))
+                    run = ''
+                self.plan.append((None, data_types[field[:-2]]))
+            elif field in data_types:
+                run += data_types[field]
+            else:
+                self.supported = False
+                self.unsupported_type = field
+                return
+        if not self.plan:
+            self.struct = struct.Struct('<' + run)
+            self.size = self.struct.size
+        else:
+            if run:
+                self.plan.append((struct.Struct('<' + run), None))
+            self.size = None
+
+    def unpack_from(self, buf, offset = 0):
+        """Decode the payload starting at offset in buf.
+
+        Returns the list of values and the offset following the payload.
+        Raises struct.error if buf is too short, KeyError if a field type is
+        not supported.
+        """
+        if not self.supported:
+            raise KeyError("unsupported field type %s" % self.unsupported_type)
+        if self.struct is not None:
+            return list(self.struct.unpack_from(buf, offset)), offset + self.size
+        values = []
+        for (run, array_type) in self.plan:
+            if run is not None:
+                values.extend(run.unpack_from(buf, offset))
+                offset += run.size
+            else:
+                array_length = struct.unpack_from('<B', buf, offset)[0]
+                array_fmt = '<%i%s' % (array_length, array_type)
+                values.append(struct.unpack_from(array_fmt, buf, offset + 1))
+                offset += 1 + struct.calcsize(array_fmt)
+        return values, offset
 
 def Usage(scmd):
     lpathitem = scmd.split('/')
@@ -23,6 +116,7 @@ where
     print(fmt % lpathitem[-1])
 
 def GetOptions():
+    global messages_path
     try:
         optlist, left_args = getopt.getopt(sys.argv[1:],'hf:', ['help','file='])
     except getopt.GetoptError:
@@ -37,7 +131,7 @@ def GetOptions():
             messages_path = a
 
 
-def ParseMessages():
+def ParseXml():
     from lxml import etree
     tree = etree.parse( messages_path)
     for the_class in tree.xpath("//class[@name]"):
@@ -70,6 +164,81 @@ def ParseMessages():
                 message_dictionary[class_name][message_name].append( the_field.attrib['name'])
                 message_dictionary_types[class_name][message_id].append( the_field.attrib['type'])
 
+def CachePath(path):
+    # one cache per interpreter major version, python 2 and 3 pickle strings differently
+    key = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, 'messages_%s_py%i.pickle' % (key, sys.version_info[0]))
+
+def CacheKey(path):
+    with open(path, 'rb') as f:
+        content = f.read()
+    return (CACHE_VERSION, os.path.abspath(path), os.path.getmtime(path), hashlib.sha1(content).hexdigest())
+
+def LoadCache(path, key):
+    try:
+        with open(CachePath(path), 'rb') as f:
+            cache = pickle.load(f)
+    except Exception:
+        return False
+    if cache.get('key') != key:
+        return False
+    for (dictionary, name) in ((message_dictionary, 'names'),
+                               (message_dictionary_types, 'types'),
+                               (message_dictionary_id_name, 'id_name'),
+                               (message_dictionary_name_id, 'name_id')):
+        dictionary.clear()
+        dictionary.update(cache[name])
+    return True
+
+def SaveCache(path, key):
+    cache = { 'key' : key,
+              'names' : message_dictionary,
+              'types' : message_dictionary_types,
+              'id_name' : message_dictionary_id_name,
+              'name_id' : message_dictionary_name_id }
+    cache_path = CachePath(path)
+    tmp_path = '%s.%i' % (cache_path, os.getpid())
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(cache, f, CACHE_PROTOCOL)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError):
+        # the cache is only an optimisation, a read-only tree still works
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+def BuildCodecs():
+    message_dictionary_codecs.clear()
+    for class_name in message_dictionary_types:
+        message_dictionary_codecs[class_name] = {}
+        for (message_id, field_types) in message_dictionary_types[class_name].items():
+            message_dictionary_codecs[class_name][message_id] = MessageCodec(field_types)
+
+def ParseMessages(force = False):
+    """Fill the message dictionaries from messages_path.
+
+    The schema is parsed once per process; further calls are no-ops unless
+    messages_path changed or force is set. The parsed dictionaries are also
+    cached on disk (keyed by path, mtime and content hash of messages.xml)
+    so that new agents skip the lxml parse altogether.
+    """
+    global parsed_path
+    if parsed_path == messages_path and not force:
+        return
+    key = CacheKey(messages_path)
+    if force or not LoadCache(messages_path, key):
+        for dictionary in (message_dictionary, message_dictionary_types,
+                           message_dictionary_id_name, message_dictionary_name_id):
+            dictionary.clear()
+        ParseXml()
+        SaveCache(messages_path, key)
+    BuildCodecs()
+    parsed_path = messages_path
+
 def test():
     GetOptions()
     ParseMessages()
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import, print_function, division
+
+# Checksum of the pprz transport: two running sums over the bytes between
+# the start byte and the checksum bytes
+#   ck_a = (ck_a + c) % 256 ; ck_b = (ck_b + ck_a) % 256
+# Unrolled, ck_a is the plain sum of the bytes and ck_b weights byte i of n
+# by (n - i), which lets both be computed with builtin sums instead of a
+# python loop.
+
+import struct
+from operator import mul
+
+def Checksum(buf, start = 0, end = None):
+    """Return (ck_a, ck_b) of buf[start:end].
+
+    buf can be any buffer (str/bytes, bytearray, memoryview), it is not
+    copied. start should point after the start byte of the frame.
+    """
+    if end is None:
+        end = len(buf)
+    length = end - start
+    data = struct.unpack_from('%iB' % length, buf, start)
+    ck_a = sum(data) & 0xFF
+    ck_b = sum(map(mul, data, range(length, 0, -1))) & 0xFF
+    return (ck_a, ck_b)
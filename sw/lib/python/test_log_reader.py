@@ -0,0 +1,97 @@
+import unittest
+import os
+import shutil
+import tempfile
+import log_reader
+
+LOG = """1.000 5 IMU_MAG_RAW 10 20 30
+1.100 5 IMU_GYRO_RAW 1 2 3
+1.200 7 IMU_MAG_RAW 11 21 31
+1.500 5 IMU_MAG_RAW 12 22 32
+2.000 5 PONG
+not a message line
+2.500 5 IMU_MAG_RAW 13 23 33
+"""
+
+class CountingReader(log_reader.LogReader):
+    """LogReader recording how many times the log was scanned."""
+    builds = 0
+
+    def BuildIndex(self):
+        CountingReader.builds += 1
+        log_reader.LogReader.BuildIndex(self)
+
+class TestLogReader(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'test.data')
+        self.write(LOG)
+        CountingReader.builds = 0
+        self.block_size = log_reader.BLOCK_SIZE
+
+    def tearDown(self):
+        log_reader.BLOCK_SIZE = self.block_size
+        shutil.rmtree(self.dir)
+
+    def write(self, text, mode = 'w'):
+        with open(self.filename, mode) as f:
+            f.write(text)
+
+    def test_index(self):
+        """The index lists ids, messages, counts and time ranges."""
+        reader = CountingReader(self.filename, use_cache = False)
+        self.assertEqual(reader.GetIds(), ['5', '7'])
+        self.assertEqual(reader.GetMessages(5), ['IMU_GYRO_RAW', 'IMU_MAG_RAW', 'PONG'])
+        self.assertEqual(reader.Count(5, 'IMU_MAG_RAW'), 3)
+        self.assertEqual(reader.TimeRange(5, 'IMU_MAG_RAW'), (1.0, 2.5))
+        self.assertEqual(reader.TimeRange(7, 'PONG'), None)
+        self.assertFalse(os.path.exists(self.filename + log_reader.INDEX_SUFFIX))
+
+    def test_lines(self):
+        """Lines only returns the lines of the message within the time range."""
+        reader = CountingReader(self.filename, use_cache = False)
+        lines = list(reader.Lines(5, 'IMU_MAG_RAW', 1.2, 2.0))
+        self.assertEqual(lines, [(1.5, [b'12', b'22', b'32'])])
+        self.assertEqual(list(reader.Lines(5, 'PONG')), [(2.0, [])])
+
+    def test_saved_index_is_reused(self):
+        """A second reader of an unchanged log loads the saved index."""
+        first = CountingReader(self.filename)
+        self.assertTrue(os.path.exists(self.filename + log_reader.INDEX_SUFFIX))
+        second = CountingReader(self.filename)
+        self.assertEqual(CountingReader.builds, 1)
+        self.assertEqual(second.spans, first.spans)
+        self.assertEqual(second.GetIds(), first.GetIds())
+
+    def test_rebuild_when_log_changes(self):
+        """The index is rebuilt once the log grew."""
+        CountingReader(self.filename)
+        self.write("3.000 9 IMU_MAG_RAW 14 24 34\n", 'a')
+        reader = CountingReader(self.filename)
+        self.assertEqual(CountingReader.builds, 2)
+        self.assertEqual(reader.GetIds(), ['5', '7', '9'])
+        self.assertEqual(reader.Count(9, 'IMU_MAG_RAW'), 1)
+
+    def test_rebuild_when_index_is_corrupt(self):
+        """An unreadable index is ignored and replaced."""
+        with open(self.filename + log_reader.INDEX_SUFFIX, 'wb') as f:
+            f.write(b'garbage')
+        reader = CountingReader(self.filename)
+        self.assertEqual(CountingReader.builds, 1)
+        self.assertEqual(reader.Count(5, 'IMU_MAG_RAW'), 3)
+        CountingReader(self.filename)
+        self.assertEqual(CountingReader.builds, 1)
+
+    def test_rebuild_when_block_size_changes(self):
+        """Blocks are part of the index key, small blocks give several spans."""
+        CountingReader(self.filename)
+        log_reader.BLOCK_SIZE = 32
+        reader = CountingReader(self.filename)
+        self.assertEqual(CountingReader.builds, 2)
+        self.assertTrue(len(reader.Spans(5, 'IMU_MAG_RAW')) > 1)
+        self.assertEqual(reader.Count(5, 'IMU_MAG_RAW'), 3)
+        self.assertEqual(len(reader.Spans(5, 'IMU_MAG_RAW', 2.2)), 1)
+
+if __name__ == '__main__':
+    unittest.main()
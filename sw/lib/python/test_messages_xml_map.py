@@ -0,0 +1,51 @@
+import unittest
+import struct
+from messages_xml_map import MessageCodec
+
+class TestMessageCodec(unittest.TestCase):
+
+    def test_fixed_layout(self):
+        """Scalar fields are decoded by one struct in field order."""
+        codec = MessageCodec(['uint8', 'int16', 'uint32', 'float', 'double'])
+        self.assertTrue(codec.supported)
+        self.assertEqual(codec.size, struct.calcsize('<BhLfd'))
+        buf = struct.pack('<BhLfd', 200, -300, 70000, 0.5, -1.25)
+        (values, offset) = codec.unpack_from(buf)
+        self.assertEqual(values, [200, -300, 70000, 0.5, -1.25])
+        self.assertEqual(offset, len(buf))
+
+    def test_offset(self):
+        """Decoding starts at offset and returns the offset after the payload."""
+        codec = MessageCodec(['int8', 'uint16'])
+        buf = b'\x99\x01' + struct.pack('<bH', -5, 1000) + b'\x00'
+        (values, offset) = codec.unpack_from(buf, 2)
+        self.assertEqual(values, [-5, 1000])
+        self.assertEqual(offset, 5)
+
+    def test_arrays(self):
+        """Arrays are length-prefixed and returned as tuples."""
+        codec = MessageCodec(['uint8', 'int16[]', 'float[]', 'uint16'])
+        self.assertTrue(codec.supported)
+        self.assertEqual(codec.size, None)
+        buf = (struct.pack('<B', 7) + struct.pack('<B3h', 3, 1, -2, 3) +
+               struct.pack('<B', 0) + struct.pack('<H', 42))
+        (values, offset) = codec.unpack_from(buf)
+        self.assertEqual(values, [7, (1, -2, 3), (), 42])
+        self.assertEqual(offset, len(buf))
+
+    def test_short_buffer(self):
+        """A truncated payload raises struct.error."""
+        codec = MessageCodec(['uint32'])
+        self.assertRaises(struct.error, codec.unpack_from, b'\x01\x02')
+        codec = MessageCodec(['uint8[]'])
+        self.assertRaises(struct.error, codec.unpack_from, b'\x04\x01')
+
+    def test_unsupported_types(self):
+        """A field of an unknown type makes the whole message unsupported."""
+        for field_types in (['uint8', 'char[]'], ['string', 'uint8'], ['foo']):
+            codec = MessageCodec(field_types)
+            self.assertFalse(codec.supported)
+            self.assertRaises(KeyError, codec.unpack_from, b'\x00' * 16)
+
+if __name__ == '__main__':
+    unittest.main()
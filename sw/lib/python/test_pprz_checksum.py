@@ -0,0 +1,34 @@
+import unittest
+from pprz_checksum import Checksum
+
+def reference_checksum(data):
+    # running sums of the pprz transport
+    ck_a = ck_b = 0
+    for c in bytearray(data):
+        ck_a = (ck_a + c) % 256
+        ck_b = (ck_b + ck_a) % 256
+    return (ck_a, ck_b)
+
+class TestChecksum(unittest.TestCase):
+
+    def test_matches_running_sums(self):
+        """The unrolled sums equal the byte by byte checksum."""
+        for length in (0, 1, 2, 17, 255, 1000):
+            data = bytes(bytearray((i * 37 + 11) % 256 for i in range(length)))
+            self.assertEqual(Checksum(data), reference_checksum(data))
+
+    def test_range(self):
+        """Only buf[start:end] is summed."""
+        frame = bytes(bytearray([0x99, 8, 1, 2, 3, 4, 0, 0]))
+        self.assertEqual(Checksum(frame, 1, 6), reference_checksum(frame[1:6]))
+        self.assertEqual(Checksum(frame, 1), reference_checksum(frame[1:]))
+
+    def test_buffers(self):
+        """Any buffer is accepted without copying."""
+        data = bytes(bytearray(range(256)))
+        expected = reference_checksum(data[3:200])
+        self.assertEqual(Checksum(bytearray(data), 3, 200), expected)
+        self.assertEqual(Checksum(memoryview(data), 3, 200), expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -25,7 +25,6 @@ import sys
 import os
 from optparse import OptionParser
 import scipy
-from scipy import optimize
 
 import calibration_utils
 
@@ -39,9 +38,18 @@ def main():
                       type="choice", choices=["ACCEL", "MAG"],
                       help="sensor to calibrate (ACCEL, MAG)",
                       action="store", default="ACCEL")
+    parser.add_option("-e", "--ellipsoid",
+                      help="fit a full ellipsoid (offset and 3x3 matrix) instead of per axis neutral and sensitivity",
+                      action="store_true", dest="ellipsoid")
     parser.add_option("-p", "--plot",
                       help="Show resulting plots",
                       action="store_true", dest="plot")
+    parser.add_option("--tmin", dest="t_min",
+                      action="store", type=float,
+                      help="only use the measurements logged after this time (s)")
+    parser.add_option("--tmax", dest="t_max",
+                      action="store", type=float,
+                      help="only use the measurements logged before this time (s)")
     parser.add_option("-v", "--verbose",
                       action="store_true", dest="verbose")
     (options, args) = parser.parse_args()
@@ -62,24 +70,15 @@ def main():
     if options.verbose:
         print("Using aircraft id "+options.ac_id)
 
-    if options.sensor == "ACCEL":
-        sensor_ref = 9.81
-        sensor_res = 10
-        noise_window = 20;
-        noise_threshold = 40;
-    elif options.sensor == "MAG":
-        sensor_ref = 1.
-        sensor_res = 11
-        noise_window = 10;
-        noise_threshold = 1000;
+    sensor_ref, sensor_res, noise_window, noise_threshold = calibration_utils.SENSOR_SETTINGS[options.sensor]
 
     if not filename.endswith(".data"):
         parser.error("Please specify a *.data log file")
     if options.verbose:
         print("reading file "+filename+" for aircraft "+options.ac_id+" and sensor "+options.sensor)
 
-    # read raw measurements from log file
-    measurements = calibration_utils.read_log(options.ac_id, filename, options.sensor)
+    # read raw measurements from log file, the index built by get_ids_in_log is reused
+    measurements = calibration_utils.read_log(options.ac_id, filename, options.sensor, options.t_min, options.t_max)
     if len(measurements) == 0:
         print("Error: found zero IMU_"+options.sensor+"_RAW measurements for aircraft with id "+options.ac_id+" in log file!")
         sys.exit(1)
@@ -94,24 +93,37 @@ def main():
         print("Error: found zero IMU_"+options.sensor+"_RAW measurements for aircraft with id "+options.ac_id+" in log file after low pass!")
         sys.exit(1)
 
-    # get an initial min/max guess
-    p0 = calibration_utils.get_min_max_guess(flt_meas, sensor_ref)
+    # get an initial min/max guess and optimize it
+    p0, p1 = calibration_utils.fit_scale(flt_meas, sensor_ref)
     cp0, np0 = calibration_utils.scale_measurements(flt_meas, p0)
     print("initial guess : avg "+str(np0.mean())+" std "+str(np0.std()))
 #    print p0
 
-    def err_func(p, meas, y):
-        cp, np = calibration_utils.scale_measurements(meas, p)
-        err = y*scipy.ones(len(meas)) - np
-        return err
-
-    p1, success = optimize.leastsq(err_func, p0[:], args=(flt_meas, sensor_ref))
     cp1, np1 = calibration_utils.scale_measurements(flt_meas, p1)
-
     print("optimized guess : avg "+str(np1.mean())+" std "+str(np1.std()))
 #    print p1
 
-    calibration_utils.print_xml(p1, options.sensor, sensor_res)
+    if options.ellipsoid:
+        q0 = calibration_utils.get_ellipsoid_guess(flt_meas, sensor_ref)
+        if q0 is None:
+            print("linear ellipsoid fit failed, starting from the optimized guess")
+            q0 = calibration_utils.ellipsoid_params(p1[0:3], scipy.diag(p1[3:6]))
+        else:
+            cq0, nq0 = calibration_utils.scale_measurements_ellipsoid(flt_meas, q0)
+            print("ellipsoid guess : avg "+str(nq0.mean())+" std "+str(nq0.std()))
+        q1 = calibration_utils.fit_ellipsoid(flt_meas, sensor_ref, q0)
+        cq1, nq1 = calibration_utils.scale_measurements_ellipsoid(flt_meas, q1)
+        print("optimized ellipsoid : avg "+str(nq1.mean())+" std "+str(nq1.std()))
+        # the airframe only takes the offset and diagonal of the ellipsoid
+        p2, cp2, np2, from_ellipsoid = calibration_utils.select_written_model(flt_meas, p1, q1)
+        if from_ellipsoid:
+            print("ellipsoid diagonal : avg "+str(np2.mean())+" std "+str(np2.std()))
+            calibration_utils.print_xml_ellipsoid(q1, options.sensor, sensor_res)
+        else:
+            print("ellipsoid diagonal fits worse than the optimized guess, keeping the optimized guess")
+            calibration_utils.print_xml(p1, options.sensor, sensor_res)
+    else:
+        calibration_utils.print_xml(p1, options.sensor, sensor_res)
     print("")
 
     if options.plot:
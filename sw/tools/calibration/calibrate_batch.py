@@ -0,0 +1,268 @@
+#! /usr/bin/env python
+
+# This file is part of Paparazzi.
+#
+# Paparazzi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# Paparazzi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Paparazzi; see the file COPYING.  If not, write to
+# the Free Software Foundation, 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+
+#
+# calibrate all the aircraft and sensors found in a set of logs
+#
+# Every (aircraft, sensor) pair with calibration messages in the logs is
+# fitted in a process pool. The best fit of each pair over all the logs is
+# written with its quality metrics in <output>/<aircraft name>_calibration.xml,
+# ready to be copied to the IMU section of the airframe.
+#
+
+import sys
+import os
+import glob
+import time
+import multiprocessing
+from optparse import OptionParser
+from xml.etree import ElementTree
+import numpy
+import scipy
+from scipy import stats
+
+import calibration_utils
+
+SENSORS = ["ACCEL", "MAG", "GYRO", "MAG_CURRENT"]
+
+# turntable rates (rad/s) used for the gyro fits, as in calibrate_gyro.py
+GYRO_MIN_RATE = 1
+GYRO_MAX_RATE = 7
+
+#
+# list the .data files of a set of files, directories and glob patterns
+#
+def find_logs(paths):
+    logs = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = glob.glob(os.path.join(path, "*.data"))
+        else:
+            matches = glob.glob(path)
+        for log in sorted(matches):
+            if log.endswith(".data") and os.path.isfile(log) and log not in logs:
+                logs.append(log)
+    return logs
+
+#
+# aircraft names by id from the .log file written by the server next to the .data
+#
+def get_ac_names(filename):
+    names = {}
+    conf = filename[:-len(".data")] + ".log"
+    if not os.path.isfile(conf):
+        return names
+    try:
+        for event, elem in ElementTree.iterparse(conf):
+            if elem.tag == "aircraft" and "ac_id" in elem.attrib and "name" in elem.attrib:
+                names[elem.attrib["ac_id"]] = elem.attrib["name"]
+            elif elem.tag == "conf":
+                # the aircraft are all described in the conf section
+                break
+    except ElementTree.ParseError:
+        pass
+    return names
+
+#
+# list the (filename, ac_id, sensor, tt_id) fits available in a log
+#
+def find_tasks(filename, sensors):
+    reader = calibration_utils.log_reader.OpenLog(filename)
+    tt_ids = [ac_id for ac_id in reader.GetIds() if reader.Count(ac_id, "IMU_TURNTABLE")]
+    tasks = []
+    for ac_id in reader.GetIds():
+        messages = reader.GetMessages(ac_id)
+        if "ACCEL" in sensors and "IMU_ACCEL_RAW" in messages:
+            tasks.append((filename, ac_id, "ACCEL", None))
+        if "MAG" in sensors and "IMU_MAG_RAW" in messages:
+            tasks.append((filename, ac_id, "MAG", None))
+        if "GYRO" in sensors and "IMU_GYRO_RAW" in messages and tt_ids:
+            tasks.append((filename, ac_id, "GYRO", tt_ids[0]))
+        if "MAG_CURRENT" in sensors and "IMU_MAG_CURRENT_CALIBRATION" in messages:
+            tasks.append((filename, ac_id, "MAG_CURRENT", None))
+    return tasks
+
+#
+# fit of ACCEL or MAG neutral and sensitivity
+#
+def calibrate_sensor(filename, ac_id, sensor, ellipsoid):
+    sensor_ref, sensor_res, noise_window, noise_threshold = calibration_utils.SENSOR_SETTINGS[sensor]
+    measurements = calibration_utils.read_log(ac_id, filename, sensor)
+    flt_meas, flt_idx = calibration_utils.filter_meas(measurements, noise_window, noise_threshold)
+    if len(flt_meas) < 6:
+        return None, "only %i of %i measurements after low pass" % (len(flt_meas), len(measurements))
+    p0, p1 = calibration_utils.fit_scale(flt_meas, sensor_ref)
+    cp1, np1 = calibration_utils.scale_measurements(flt_meas, p1)
+    xml = calibration_utils.get_xml(p1, sensor, sensor_res)
+    norms = np1
+    if ellipsoid:
+        q0 = calibration_utils.get_ellipsoid_guess(flt_meas, sensor_ref)
+        if q0 is None:
+            q0 = calibration_utils.ellipsoid_params(p1[0:3], scipy.diag(p1[3:6]))
+        q1 = calibration_utils.fit_ellipsoid(flt_meas, sensor_ref, q0)
+        p2, cp2, norms, from_ellipsoid = calibration_utils.select_written_model(flt_meas, p1, q1)
+        if from_ellipsoid:
+            xml = calibration_utils.get_xml_ellipsoid(q1, sensor, sensor_res)
+    std = norms.std()
+    metrics = "%i measurements, %i after low pass, norm avg %.4f std %.4f (%.2f%%)" % \
+              (len(measurements), len(flt_meas), norms.mean(), std, 100*std/sensor_ref)
+    return (std/sensor_ref, xml, metrics), None
+
+#
+# regression of the gyros against the turntable rate, for the axes that turned
+#
+def calibrate_gyro(filename, ac_id, tt_id):
+    samples = calibration_utils.read_turntable_log(ac_id, tt_id, filename, GYRO_MIN_RATE, GYRO_MAX_RATE)
+    if len(samples) < 3:
+        return None, "found %i gyro samples on the turntable" % len(samples)
+    xml = []
+    metrics = []
+    quality = []
+    for axis, a, b, r, stderr in calibration_utils.fit_gyro(samples):
+        xml += calibration_utils.get_gyro_xml(axis, a, b)
+        metrics.append("%s: %i samples, a=%.2f b=%.2f r=%.4f std error=%.3f" % (axis, len(samples), a, b, r, stderr))
+        quality.append(1 - r*r)
+    if not xml:
+        return None, "no gyro axis follows the turntable rate"
+    return (max(quality), xml, "; ".join(metrics)), None
+
+#
+# linear relation of the magnetometers with the current
+#
+def calibrate_mag_current(filename, ac_id):
+    measurements = calibration_utils.read_log_mag_current(ac_id, filename)
+    if len(measurements) < 3:
+        return None, "found %i measurements" % len(measurements)
+    coefficient = calibration_utils.estimate_mag_current_relation(measurements)
+    r = [stats.linregress(measurements[:, 3], measurements[:, i])[2] for i in range(0, 3)]
+    xml = ["<define name=\"MAG_%s_CURRENT_COEF\" value=\"%s\"/>" % (axis, str(coef))
+           for axis, coef in zip("XYZ", coefficient)]
+    metrics = "%i measurements, r=%.4f %.4f %.4f" % (len(measurements), r[0], r[1], r[2])
+    r2 = [v*v for v in r if not numpy.isnan(v)]
+    return (1 - max(r2 or [0]), xml, metrics), None
+
+#
+# run one fit in a worker, returns the task, the (quality, xml, metrics) of the
+# fit or None, and an error message
+#
+def run_task(args):
+    (task, ellipsoid) = args
+    (filename, ac_id, sensor, tt_id) = task
+    try:
+        if sensor == "GYRO":
+            result, error = calibrate_gyro(filename, ac_id, tt_id)
+        elif sensor == "MAG_CURRENT":
+            result, error = calibrate_mag_current(filename, ac_id)
+        else:
+            result, error = calibrate_sensor(filename, ac_id, sensor, ellipsoid)
+    except Exception as e:
+        result, error = None, "%s: %s" % (e.__class__.__name__, e)
+    return task, result, error
+
+#
+# write the calibration of one aircraft
+#
+def write_calibration(output_dir, name, ac_id, fits):
+    path = os.path.join(output_dir, name + "_calibration.xml")
+    f = open(path, "w")
+    f.write("<!-- calibration of %s (ac_id %s), %s -->\n" % (name, ac_id, time.strftime("%Y-%m-%d %H:%M:%S")))
+    f.write("<section name=\"IMU\" prefix=\"IMU_\">\n")
+    for sensor in SENSORS:
+        if sensor not in fits:
+            continue
+        filename, (quality, xml, metrics) = fits[sensor]
+        f.write("\n  <!-- %s from %s -->\n" % (sensor, os.path.basename(filename)))
+        f.write("  <!-- %s -->\n" % metrics)
+        for line in xml:
+            f.write("  " + line + "\n")
+    f.write("</section>\n")
+    f.close()
+    return path
+
+def main():
+    usage = "usage: %prog [options] log_directory|log_filename.data|'glob' ..." + "\n" + "Run %prog --help to list the options."
+    parser = OptionParser(usage)
+    parser.add_option("-o", "--output", dest="output_dir",
+                      action="store", default=".",
+                      help="directory where the calibration of each aircraft is written")
+    parser.add_option("-s", "--sensor", dest="sensors",
+                      type="choice", choices=SENSORS, action="append",
+                      help="sensor to calibrate (ACCEL, MAG, GYRO, MAG_CURRENT), can be repeated, default all")
+    parser.add_option("-e", "--ellipsoid",
+                      help="also fit full ellipsoids for ACCEL and MAG, kept when better",
+                      action="store_true", dest="ellipsoid")
+    parser.add_option("-j", "--jobs", dest="jobs",
+                      action="store", type=int, default=multiprocessing.cpu_count(),
+                      help="number of fits run in parallel")
+    parser.add_option("-v", "--verbose",
+                      action="store_true", dest="verbose")
+    (options, args) = parser.parse_args()
+    if len(args) == 0:
+        parser.error("incorrect number of arguments")
+    if options.sensors is None:
+        options.sensors = SENSORS
+
+    logs = find_logs(args)
+    if len(logs) == 0:
+        print("no .data log found in " + " ".join(args))
+        sys.exit(1)
+    if not os.path.isdir(options.output_dir):
+        os.makedirs(options.output_dir)
+
+    # index the logs once here, the workers reuse the indexes saved next to them
+    tasks = []
+    names = {}
+    for filename in logs:
+        if options.verbose:
+            print("indexing " + filename)
+        tasks += find_tasks(filename, options.sensors)
+        for ac_id, name in get_ac_names(filename).items():
+            names.setdefault(ac_id, name)
+    if options.verbose:
+        print("running %i fits on %i logs" % (len(tasks), len(logs)))
+
+    # best fit of each sensor of each aircraft over all the logs
+    fits = {}
+    pool = multiprocessing.Pool(max(options.jobs, 1))
+    try:
+        for task, result, error in pool.imap_unordered(run_task, [(task, options.ellipsoid) for task in tasks]):
+            (filename, ac_id, sensor, tt_id) = task
+            if result is None:
+                print("%s: %s of aircraft %s skipped, %s" % (filename, sensor, ac_id, error))
+                continue
+            if options.verbose:
+                print("%s: %s of aircraft %s, %s" % (filename, sensor, ac_id, result[2]))
+            ac_fits = fits.setdefault(ac_id, {})
+            if sensor not in ac_fits or result[0] < ac_fits[sensor][1][0]:
+                ac_fits[sensor] = (filename, result)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    pool.join()
+
+    for ac_id in sorted(fits, key=lambda i: (len(i), i)):
+        name = names.get(ac_id, "ac_" + ac_id)
+        path = write_calibration(options.output_dir, name, ac_id, fits[ac_id])
+        print("%s (%s): %s -> %s" % (name, ac_id, ", ".join(s for s in SENSORS if s in fits[ac_id]), path))
+
+
+if __name__ == "__main__":
+    main()
@@ -27,7 +27,6 @@ from optparse import OptionParser
 import os
 import sys
 
-import re
 import scipy
 from scipy import linspace, polyval, polyfit, sqrt, stats, randn
 from pylab import *
@@ -54,7 +53,7 @@ import calibration_utils
 
 
 def main():
-    usage = "usage: %prog --id <ac_id> --tt_id <tt_id> --axis <axis> [options] log_filename.data" + "\n" + "Run %prog --help to list the options."
+    usage = "usage: %prog --id <ac_id> --tt_id <tt_id> [options] log_filename.data" + "\n" + "Run %prog --help to list the options."
     parser = OptionParser(usage)
     parser.add_option("-i", "--id", dest="ac_id",
                       action="store", type=int, default=-1,
@@ -64,8 +63,15 @@ def main():
                       help="turntable id to use")
     parser.add_option("-a", "--axis", dest="axis",
                       type="choice", choices=['p', 'q', 'r'],
-                      help="axis to calibrate (p, q, r)",
+                      help="axis to calibrate (p, q, r), default all the axes following the turntable",
                       action="store")
+    parser.add_option("-m", "--merge", dest="merge",
+                      type="choice", choices=['last', 'nearest', 'interp'], default='last',
+                      help="turntable rate of a gyro sample: last one logged before it (default), nearest in time or interpolated",
+                      action="store")
+    parser.add_option("--tolerance", dest="tolerance",
+                      action="store", type=float,
+                      help="maximum time (s) between a gyro sample and the turntable rate used")
     parser.add_option("-v", "--verbose",
                       action="store_true", dest="verbose")
     (options, args) = parser.parse_args()
@@ -87,7 +93,7 @@ def main():
     if options.verbose:
         print("reading file "+filename+" for aircraft "+str(options.ac_id)+" and turntable "+str(options.tt_id))
 
-    samples =  calibration_utils.read_turntable_log(options.ac_id, options.tt_id, filename, 1, 7)
+    samples = calibration_utils.read_turntable_log(options.ac_id, options.tt_id, filename, 1, 7, options.merge, options.tolerance)
 
     if len(samples) == 0:
         print("Error: found zero matching messages in log file!")
@@ -96,29 +102,27 @@ def main():
     if options.verbose:
        print("found "+str(len(samples))+" records")
 
-    if options.axis == 'p':
-        axis_idx = 1
-    elif options.axis == 'q':
-        axis_idx = 2
-    elif options.axis == 'r':
-        axis_idx = 3
+    #Linear regression using stats.linregress, all axes in one pass
+    if options.axis is None:
+        fits = calibration_utils.fit_gyro(samples)
     else:
-        parser.error("Specify a valid axis!")
+        fits = [f for f in calibration_utils.fit_gyro(samples, -1) if f[0] == options.axis.upper()]
+    if len(fits) == 0:
+        print("Error: no gyro axis follows the turntable rate!")
+        sys.exit(1)
+    axis_idx = { 'P' : 1, 'Q' : 2, 'R' : 3 }
 
-    #Linear regression using stats.linregress
-    t  = samples[:, 0]
-    xn = samples[:, axis_idx]
-    (a_s, b_s, r, tt, stderr)=stats.linregress(t, xn)
     print('Linear regression using stats.linregress')
-    print(('regression: a=%.2f b=%.2f, std error= %.3f' % (a_s, b_s, stderr)))
-    print(('<define name="GYRO_X_NEUTRAL" value="%d"/>' % (b_s)));
-    print(('<define name="GYRO_X_SENS" value="%f" integer="16"/>' % (pow(2, 12)/a_s)));
+    for (axis, a_s, b_s, r, stderr) in fits:
+        print(('%s regression: a=%.2f b=%.2f, r=%.4f, std error= %.3f' % (axis, a_s, b_s, r, stderr)))
+    for (axis, a_s, b_s, r, stderr) in fits:
+        for line in calibration_utils.get_gyro_xml(axis, a_s, b_s):
+            print(line)
 
     #
     # overlay fited value
     #
     ovl_omega = linspace(1, 7.5, 10)
-    ovl_adc = polyval([a_s, b_s], ovl_omega)
 
     title('Linear Regression Example')
     subplot(3, 1, 1)
@@ -131,8 +135,9 @@ def main():
     plot(samples[:, 0])
 
     subplot(3, 1, 3)
-    plot(samples[:, 0], samples[:, axis_idx], 'b.')
-    plot(ovl_omega, ovl_adc, 'r')
+    for (axis, a_s, b_s, r, stderr) in fits:
+        plot(samples[:, 0], samples[:, axis_idx[axis]], 'b.')
+        plot(ovl_omega, polyval([a_s, b_s], ovl_omega), 'r')
 
     show();
 
@@ -0,0 +1,266 @@
+#! /usr/bin/env python
+
+# This file is part of Paparazzi.
+#
+# Paparazzi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# Paparazzi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Paparazzi; see the file COPYING.  If not, write to
+# the Free Software Foundation, 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+#
+
+#
+# calibrate accelerometers and magnetometers from the live telemetry
+#
+# The IMU_MAG_RAW and IMU_ACCEL_RAW messages are accumulated in the normal
+# equations of a linear fit of the quadric through the measurements (a 9x9
+# matrix and a 9 vector), so every sample costs the same and the memory does
+# not grow with time. The quadric is normalized by a + b + c = 1 rather than
+# by its constant term, which keeps the fit independent of the origin of the
+# measurements while they are accumulated.
+#
+# The airframe only takes a neutral and a sensitivity per axis, so a few
+# samples of each direction are also kept to fit that model, and to check
+# whether the offset and diagonal of the ellipsoid fit them better.
+#
+# While the airframe is rotated the neutral and sensitivity estimates are
+# sent on the bus as IMU_CALIBRATION ground messages, with the coverage of
+# the directions seen so far and the std of the calibrated norms. The
+# defines are printed when the agent is stopped.
+#
+
+import sys
+import time
+import threading
+from collections import deque
+from optparse import OptionParser
+import numpy
+from scipy import linalg
+
+import calibration_utils
+import messages_tool
+from ivy.std_api import *
+
+# the directions are binned on the faces of a cube, each cut in DIVISIONS^2 cells
+COVERAGE_DIVISIONS = 3
+COVERAGE_CELLS = 6 * COVERAGE_DIVISIONS**2
+# the coverage restarts when the center moves by more than this part of the radius
+COVERAGE_RESET = 0.1
+# samples kept in each cell to fit and score the written model
+SAMPLES_PER_CELL = 20
+
+#
+# coverage cell of the direction of vector d
+#
+def coverage_cell(d):
+    a = [abs(d[0]), abs(d[1]), abs(d[2])]
+    axis = a.index(max(a))
+    if a[axis] == 0:
+        return None
+    u = d[(axis+1) % 3] / a[axis]
+    v = d[(axis+2) % 3] / a[axis]
+    i = min(int((u+1)/2*COVERAGE_DIVISIONS), COVERAGE_DIVISIONS-1)
+    j = min(int((v+1)/2*COVERAGE_DIVISIONS), COVERAGE_DIVISIONS-1)
+    face = 2*axis + (d[axis] < 0)
+    return (face*COVERAGE_DIVISIONS + i)*COVERAGE_DIVISIONS + j
+
+
+class SensorCalibration:
+    """Running linear ellipsoid fit of one sensor of one aircraft."""
+    def __init__(self, sensor):
+        self.sensor = sensor
+        self.sensor_ref, self.sensor_res = calibration_utils.SENSOR_SETTINGS[sensor][0:2]
+        # normal equations E'E w = E'r of the quadric fit, on (meas - offset) * unit
+        self.EtE = numpy.zeros((9, 9))
+        self.Etr = numpy.zeros(9)
+        self.offset = None
+        self.unit = 1.
+        self.nb_samples = 0
+        self.sum = numpy.zeros(3)
+        self.cells = [False] * COVERAGE_CELLS
+        self.nb_cells = 0
+        self.samples = [deque(maxlen=SAMPLES_PER_CELL) for i in range(COVERAGE_CELLS)]
+        self.center = None
+        self.q = None
+        # written neutral and sensitivity, and whether they come from the ellipsoid
+        self.p = None
+        self.from_ellipsoid = False
+        self.residual = 0.
+
+    def AddSample(self, meas):
+        meas = numpy.array(meas, dtype=float)
+        if self.offset is None:
+            # keep the terms of the normal equations close to 1
+            self.offset = meas
+            self.unit = 1. / max(linalg.norm(meas), 1.)
+        x, y, z = (meas - self.offset) * self.unit
+        # a*(x^2 - z^2) + b*(y^2 - z^2) + 2d*xy + 2e*xz + 2f*yz + 2g*x + 2h*y + 2i*z + j = -z^2
+        row = numpy.array([x*x - z*z, y*y - z*z, 2*x*y, 2*x*z, 2*y*z, 2*x, 2*y, 2*z, 1.])
+        self.EtE += numpy.outer(row, row)
+        self.Etr -= z*z * row
+        self.nb_samples += 1
+        self.sum += meas
+
+        # directions seen from the current estimate of the center
+        if self.center is not None:
+            center = self.center
+        else:
+            center = self.sum / self.nb_samples
+        self.AddToCell(meas, center)
+
+    def AddToCell(self, meas, center):
+        cell = coverage_cell(meas - center)
+        if cell is None:
+            return
+        self.samples[cell].append(meas)
+        if not self.cells[cell]:
+            self.cells[cell] = True
+            self.nb_cells += 1
+
+    def Samples(self):
+        return numpy.array([meas for cell in self.samples for meas in cell])
+
+    def Coverage(self):
+        return float(self.nb_cells) / COVERAGE_CELLS
+
+    def Solve(self):
+        """Update the ellipsoid estimate, returns it or None if there is none yet."""
+        if self.nb_samples < 9:
+            return None
+        try:
+            w = linalg.solve(self.EtE, self.Etr)
+        except linalg.LinAlgError:
+            return None
+        # back to the coefficients a..j of calibration_utils.ellipsoid_from_quadric
+        v = numpy.array([w[0], w[1], 1 - w[0] - w[1], w[2], w[3], w[4], w[5], w[6], w[7], w[8]])
+        q = calibration_utils.ellipsoid_from_quadric(v, self.sensor_ref, self.offset, self.unit)
+        if q is None:
+            return None
+        self.q = q
+        # the cells were binned around another center, count them again
+        matrix = calibration_utils.ellipsoid_matrix(q)
+        if self.center is None or linalg.norm(matrix.dot(q[0:3] - self.center)) > COVERAGE_RESET * self.sensor_ref:
+            samples = self.Samples()
+            self.cells = [False] * COVERAGE_CELLS
+            self.nb_cells = 0
+            self.samples = [deque(maxlen=SAMPLES_PER_CELL) for i in range(COVERAGE_CELLS)]
+            self.center = q[0:3]
+            for meas in samples:
+                self.AddToCell(meas, self.center)
+        # the airframe only takes a neutral and a sensitivity per axis, score that model
+        samples = self.Samples()
+        if len(samples) >= 6:
+            p0, p1 = calibration_utils.fit_scale(samples, self.sensor_ref)
+            self.p, cp, np, self.from_ellipsoid = calibration_utils.select_written_model(samples, p1, q)
+        else:
+            self.p, self.from_ellipsoid = q[0:6], True
+            cp, np = calibration_utils.scale_measurements(samples.reshape(-1, 3), self.p)
+        self.residual = np.std() if len(np) else 0.
+        return q
+
+
+class LiveCalibration:
+    def __init__(self, ac_id, sensors, verbose):
+        self.ac_id = ac_id
+        self.verbose = verbose
+        # (ac_id, sensor) -> SensorCalibration
+        self.calibrations = {}
+        self.lock = threading.Lock()
+        regex = "^(\S+ IMU_(?:%s)_RAW .*)" % "|".join(sensors)
+        self.interface = messages_tool.IvyMessagesInterface(self.OnMessage, True, regex)
+
+    def OnMessage(self, ac_id, name, values):
+        if self.ac_id is not None and ac_id != self.ac_id:
+            return
+        try:
+            meas = [float(v) for v in values[0:3]]
+        except ValueError:
+            return
+        if len(meas) != 3:
+            return
+        key = (ac_id, name[len("IMU_"):-len("_RAW")])
+        with self.lock:
+            calibration = self.calibrations.get(key)
+            if calibration is None:
+                calibration = self.calibrations[key] = SensorCalibration(key[1])
+            calibration.AddSample(meas)
+
+    def Publish(self):
+        with self.lock:
+            for (ac_id, sensor), calibration in sorted(self.calibrations.items()):
+                if calibration.Solve() is None:
+                    continue
+                p = calibration.p
+                sens = p[3:6] * 2**calibration.sensor_res
+                IvySendMsg("calib IMU_CALIBRATION %i %s %f %f %f %f %f %f %.2f %i %f" % (
+                    ac_id, sensor, p[0], p[1], p[2], sens[0], sens[1], sens[2],
+                    calibration.Coverage(), calibration.nb_samples, calibration.residual))
+                if self.verbose:
+                    print("%i %s: neutral %.1f %.1f %.1f sens %.4f %.4f %.4f coverage %.2f std %.4f (%i samples)" % (
+                        ac_id, sensor, p[0], p[1], p[2], sens[0], sens[1], sens[2],
+                        calibration.Coverage(), calibration.residual, calibration.nb_samples))
+
+    def PrintXml(self):
+        with self.lock:
+            for (ac_id, sensor), calibration in sorted(self.calibrations.items()):
+                if calibration.q is None:
+                    continue
+                print("")
+                print("<!-- aircraft %i, %i samples, coverage %.2f, norm std %.4f -->" % (
+                    ac_id, calibration.nb_samples, calibration.Coverage(), calibration.residual))
+                if calibration.from_ellipsoid:
+                    lines = calibration_utils.get_xml_ellipsoid(calibration.q, sensor, calibration.sensor_res)
+                else:
+                    lines = calibration_utils.get_xml(calibration.p, sensor, calibration.sensor_res)
+                for line in lines:
+                    print(line)
+
+    def Run(self, period):
+        try:
+            while True:
+                time.sleep(period)
+                self.Publish()
+        except KeyboardInterrupt:
+            pass
+        # last estimates, sent while the bus is still up
+        self.Publish()
+        self.PrintXml()
+        self.interface.Shutdown()
+
+
+def main():
+    usage = "usage: %prog [options]" + "\n" + "Run %prog --help to list the options."
+    parser = OptionParser(usage)
+    parser.add_option("-i", "--id", dest="ac_id",
+                      action="store", type=int,
+                      help="aircraft id to calibrate, default all")
+    parser.add_option("-s", "--sensor", dest="sensors",
+                      type="choice", choices=["ACCEL", "MAG"], action="append",
+                      help="sensor to calibrate (ACCEL, MAG), can be repeated, default MAG")
+    parser.add_option("-p", "--period", dest="period",
+                      action="store", type=float, default=1.,
+                      help="period of the estimates in seconds")
+    parser.add_option("-v", "--verbose",
+                      action="store_true", dest="verbose")
+    (options, args) = parser.parse_args()
+    if len(args) != 0:
+        parser.error("incorrect number of arguments")
+    if options.sensors is None:
+        options.sensors = ["MAG"]
+
+    print("Rotate the airframe in all directions, Ctrl-C to stop and print the calibration")
+    calibration = LiveCalibration(options.ac_id, options.sensors, options.verbose)
+    calibration.Run(options.period)
+
+
+if __name__ == "__main__":
+    main()
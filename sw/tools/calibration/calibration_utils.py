@@ -20,75 +20,120 @@
 # Boston, MA 02111-1307, USA.
 #
 
-import re
+import os
+import sys
+import numpy
 import scipy
 from scipy import linalg
 from scipy import stats
+from scipy import optimize
 from pylab import *
 from mpl_toolkits.mplot3d import Axes3D
 
+# the calibration tools are also run outside of the paparazzi environment
+PPRZ_HOME = os.getenv("PAPARAZZI_HOME", os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../..')))
+sys.path.append(PPRZ_HOME + "/sw/lib/python")
+
+import messages_xml_map
+import log_reader
+
+if os.getenv("PAPARAZZI_HOME") is None:
+    messages_xml_map.messages_path = PPRZ_HOME + "/conf/messages.xml"
+    messages_xml_map.cache_dir = PPRZ_HOME + "/var"
+
 #
 # returns available ac_id from a log
 #
 def get_ids_in_log(filename):
-    f = open(filename, 'r')
-    ids = []
-    pattern = re.compile("\S+ (\S+)")
-    while True:
-        line = f.readline().strip()
-        if line == '':
-            break
-        m=re.match(pattern, line)
-        if m:
-            id = m.group(1)
-            if not id in ids:
-              ids.append(id)
-    return ids
+    return log_reader.OpenLog(filename).GetIds()
+
+#
+# reference norm, resolution of the sensitivity and noise filter (window, threshold) of each sensor
+#
+SENSOR_SETTINGS = { 'ACCEL' : (9.81, 10, 20, 40),
+                    'MAG'   : (1., 11, 10, 1000) }
+
+#
+# field names of the raw measurements of each sensor
+#
+SENSOR_FIELDS = { 'ACCEL' : ('ax', 'ay', 'az'),
+                  'MAG'   : ('mx', 'my', 'mz'),
+                  'GYRO'  : ('gp', 'gq', 'gr') }
+
+#
+# extracts a message from a log as a structured array with named columns
+#
+def read_log_message(ac_id, filename, msg_name, t_min=None, t_max=None):
+    return log_reader.OpenLog(filename).ReadMessage(ac_id, msg_name, t_min, t_max)
+
+#
+# stack the named columns of a message in a measurement array
+#
+def get_columns(data, fields):
+    return scipy.column_stack([data[f].astype(float) for f in fields]) if len(data) else scipy.zeros((0, len(fields)))
 
 #
 # extracts raw sensor measurements from a log
 #
-def read_log(ac_id, filename, sensor):
-    f = open(filename, 'r')
-    pattern = re.compile("(\S+) "+ac_id+" IMU_"+sensor+"_RAW (\S+) (\S+) (\S+)")
-    list_meas = []
-    while True:
-        line = f.readline().strip()
-        if line == '':
-            break
-        m=re.match(pattern, line)
-        if m:
-            list_meas.append([float(m.group(2)), float(m.group(3)), float(m.group(4))])
-    return scipy.array(list_meas)
+def read_log(ac_id, filename, sensor, t_min=None, t_max=None):
+    data = read_log_message(ac_id, filename, "IMU_"+sensor+"_RAW", t_min, t_max)
+    return get_columns(data, SENSOR_FIELDS[sensor])
 
 #
 # extracts raw magnetometer and current measurements from a log
 #
-def read_log_mag_current(ac_id, filename):
-    f = open(filename, 'r')
-    pattern = re.compile("(\S+) "+ac_id+" IMU_MAG_CURRENT_CALIBRATION (\S+) (\S+) (\S+) (\S+)")
-    list_meas = []
-    while True:
-        line = f.readline().strip()
-        if line == '':
-            break
-        m=re.match(pattern, line)
-        if m:
-            list_meas.append([float(m.group(2)), float(m.group(3)), float(m.group(4)), float(m.group(5))])
-    return scipy.array(list_meas)
+def read_log_mag_current(ac_id, filename, t_min=None, t_max=None):
+    data = read_log_message(ac_id, filename, "IMU_MAG_CURRENT_CALIBRATION", t_min, t_max)
+    return get_columns(data, SENSOR_FIELDS['MAG'] + ('electrical_current',))
+
+#
+# extracts raw sensor measurements from a log, by parts of the log
+#
+def read_log_chunks(ac_id, filename, sensor, t_min=None, t_max=None):
+    reader = log_reader.OpenLog(filename)
+    for data in reader.ReadMessageChunks(ac_id, "IMU_"+sensor+"_RAW", t_min, t_max):
+        yield get_columns(data, SENSOR_FIELDS[sensor])
 
 #
 # select only non-noisy data
+# a sample is kept if the norm of the std of the 2*window_size samples around
+# it is below the threshold, the window sums are taken from cumulative sums
 #
 def filter_meas(meas, window_size, noise_threshold):
-    filtered_meas = []
-    filtered_idx = []
-    for i in range(window_size, len(meas)-window_size):
-        noise = meas[i-window_size:i+window_size,:].std(axis=0)
-        if  linalg.norm(noise) < noise_threshold:
-            filtered_meas.append(meas[i,:])
-            filtered_idx.append(i)
-    return scipy.array(filtered_meas), filtered_idx
+    idx = numpy.arange(window_size, len(meas)-window_size)
+    if window_size <= 0 or len(idx) == 0:
+        return scipy.array([]), []
+    # center the data to keep the variance accurate with large raw values
+    centered = meas - meas.mean(axis=0)
+    sums = numpy.zeros((len(meas)+1, meas.shape[1]))
+    numpy.cumsum(centered, axis=0, out=sums[1:])
+    sq_sums = numpy.zeros((len(meas)+1, meas.shape[1]))
+    numpy.cumsum(centered**2, axis=0, out=sq_sums[1:])
+    n = 2*window_size
+    mean = (sums[idx+window_size] - sums[idx-window_size]) / n
+    var = (sq_sums[idx+window_size] - sq_sums[idx-window_size]) / n - mean**2
+    noise = numpy.sqrt(numpy.maximum(var, 0).sum(axis=1))
+    filtered_idx = idx[noise < noise_threshold]
+    return meas[filtered_idx], filtered_idx.tolist()
+
+#
+# filter_meas over successive parts of the measurements, e.g. from read_log_chunks
+# yields the (filtered_meas, filtered_idx) of each part, indexes counted from the first part
+#
+def filter_meas_chunks(chunks, window_size, noise_threshold):
+    tail = None
+    offset = 0
+    for chunk in chunks:
+        if tail is not None and len(tail):
+            meas = numpy.concatenate((tail, chunk))
+        else:
+            meas = chunk
+        flt_meas, flt_idx = filter_meas(meas, window_size, noise_threshold)
+        if len(flt_idx):
+            yield flt_meas, [i + offset for i in flt_idx]
+        # keep the samples needed to complete the windows of the next part
+        tail = meas[max(len(meas) - 2*window_size, 0):]
+        offset += len(meas) - len(tail)
 
 
 #
@@ -106,13 +151,138 @@ def get_min_max_guess(meas, scale):
 # scale the set of measurements
 #
 def scale_measurements(meas, p):
-    l_comp = [];
-    l_norm = [];
-    for m in meas[:,]:
-        sm = (m - p[0:3])*p[3:6]
-        l_comp.append(sm)
-        l_norm.append(linalg.norm(sm))
-    return scipy.array(l_comp), scipy.array(l_norm)
+    l_comp = (meas - p[0:3])*p[3:6]
+    l_norm = numpy.sqrt((l_comp**2).sum(axis=1))
+    return l_comp, l_norm
+
+#
+# jacobian of the norms of scale_measurements with respect to p
+#
+def scale_measurements_jacobian(meas, p):
+    centered = meas - p[0:3]
+    l_comp = centered*p[3:6]
+    l_norm = numpy.sqrt((l_comp**2).sum(axis=1))[:, numpy.newaxis]
+    # d|c|/dn = -c*s/|c| and d|c|/ds = c*(m-n)/|c|
+    return numpy.hstack((-l_comp*p[3:6], l_comp*centered)) / l_norm
+
+#
+# ellipsoid model: offset and symmetric 3x3 matrix packed in 9 parameters
+# calibrated = matrix * (meas - offset)
+#
+def ellipsoid_params(offset, matrix):
+    return scipy.array([offset[0], offset[1], offset[2],
+                        matrix[0, 0], matrix[1, 1], matrix[2, 2],
+                        matrix[0, 1], matrix[0, 2], matrix[1, 2]])
+
+def ellipsoid_matrix(q):
+    return scipy.array([[q[3], q[6], q[7]],
+                        [q[6], q[4], q[8]],
+                        [q[7], q[8], q[5]]])
+
+#
+# scale the set of measurements with the ellipsoid model
+#
+def scale_measurements_ellipsoid(meas, q):
+    l_comp = (meas - q[0:3]).dot(ellipsoid_matrix(q).T)
+    l_norm = numpy.sqrt((l_comp**2).sum(axis=1))
+    return l_comp, l_norm
+
+#
+# jacobian of the norms of scale_measurements_ellipsoid with respect to q
+#
+def scale_measurements_ellipsoid_jacobian(meas, q):
+    centered = meas - q[0:3]
+    l_comp = centered.dot(ellipsoid_matrix(q).T)
+    l_norm = numpy.sqrt((l_comp**2).sum(axis=1))[:, numpy.newaxis]
+    c, d = l_comp, centered
+    return numpy.hstack((-l_comp.dot(ellipsoid_matrix(q)),
+                         c*d,
+                         c[:, 0:1]*d[:, 1:2] + c[:, 1:2]*d[:, 0:1],
+                         c[:, 0:1]*d[:, 2:3] + c[:, 2:3]*d[:, 0:1],
+                         c[:, 1:2]*d[:, 2:3] + c[:, 2:3]*d[:, 1:2])) / l_norm
+
+#
+# ellipsoid model from the coefficients v of the quadric
+# a*x^2 + b*y^2 + c*z^2 + 2d*xy + 2e*xz + 2f*yz + 2g*x + 2h*y + 2i*z + j = 0
+# fitted on measurements expressed as (meas - offset) * unit
+# returns None if the quadric is not an ellipsoid
+#
+def ellipsoid_from_quadric(v, scale, offset=0., unit=1.):
+    M = scipy.array([[v[0], v[3], v[4]],
+                     [v[3], v[1], v[5]],
+                     [v[4], v[5], v[2]]])
+    try:
+        center = -linalg.solve(M, v[6:9])
+    except linalg.LinAlgError:
+        return None
+    k = center.dot(M).dot(center) - v[9]
+    if k == 0:
+        return None
+    eig_val, eig_vec = linalg.eigh(M / k)
+    if (eig_val <= 0).any():
+        return None
+    # symmetric square root of the quadric maps the ellipsoid on the unit sphere
+    matrix = scale * eig_vec.dot(numpy.diag(numpy.sqrt(eig_val))).dot(eig_vec.T)
+    return ellipsoid_params(center / unit + offset, matrix * unit)
+
+#
+# rows of the linear least squares system of the quadric with j = -1
+#
+def quadric_rows(x, y, z):
+    return numpy.column_stack((x*x, y*y, z*z, 2*x*y, 2*x*z, 2*y*z, 2*x, 2*y, 2*z))
+
+#
+# initial ellipsoid from a linear least squares fit of the quadric
+# returns None if the measurements do not describe an ellipsoid
+#
+def get_ellipsoid_guess(meas, scale):
+    # work around the mean to keep the system well conditioned
+    mean = meas.mean(axis=0)
+    x, y, z = (meas - mean).T
+    v = linalg.lstsq(quadric_rows(x, y, z), numpy.ones(len(meas)))[0]
+    return ellipsoid_from_quadric(numpy.append(v, -1.), scale, mean)
+
+#
+# least squares fit of neutral and sensitivity, returns the min/max guess and the fit
+#
+def fit_scale(flt_meas, sensor_ref):
+    def err_func(p, meas, y):
+        cp, np = scale_measurements(meas, p)
+        return y - np
+
+    def err_jac(p, meas, y):
+        return -scale_measurements_jacobian(meas, p)
+
+    p0 = get_min_max_guess(flt_meas, sensor_ref)
+    p1, success = optimize.leastsq(err_func, p0[:], args=(flt_meas, sensor_ref), Dfun=err_jac)
+    return p0, p1
+
+#
+# least squares fit of the ellipsoid model starting from q0
+#
+def fit_ellipsoid(flt_meas, sensor_ref, q0):
+    def err_func(q, meas, y):
+        cq, nq = scale_measurements_ellipsoid(meas, q)
+        return y - nq
+
+    def err_jac(q, meas, y):
+        return -scale_measurements_ellipsoid_jacobian(meas, q)
+
+    q1, success = optimize.leastsq(err_func, q0[:], args=(flt_meas, sensor_ref), Dfun=err_jac)
+    return q1
+
+#
+# neutral and sensitivity written for the ellipsoid q: the airframe only takes its
+# offset and diagonal, they are kept if that model fits the measurements better than
+# the per axis fit p. Returns the written parameters, the scaled measurements and
+# norms of that model, and whether it comes from the ellipsoid
+#
+def select_written_model(meas, p, q):
+    cp, np = scale_measurements(meas, p)
+    cq, nq = scale_measurements(meas, q[0:6])
+    if nq.std() < np.std():
+        return q[0:6], cq, nq, True
+    return p, cp, np, False
 
 #
 # calculate linear coefficient of magnetometer-current relation
@@ -124,18 +294,41 @@ def estimate_mag_current_relation(meas):
         coefficient.append(gradient)
     return coefficient
 
+#
+# xml defines for airframe file
+#
+def get_xml(p, sensor, res):
+    return ["<define name=\""+sensor+"_X_NEUTRAL\" value=\""+str(int(round(p[0])))+"\"/>",
+            "<define name=\""+sensor+"_Y_NEUTRAL\" value=\""+str(int(round(p[1])))+"\"/>",
+            "<define name=\""+sensor+"_Z_NEUTRAL\" value=\""+str(int(round(p[2])))+"\"/>",
+            "<define name=\""+sensor+"_X_SENS\" value=\""+str(p[3]*2**res)+"\" integer=\"16\"/>",
+            "<define name=\""+sensor+"_Y_SENS\" value=\""+str(p[4]*2**res)+"\" integer=\"16\"/>",
+            "<define name=\""+sensor+"_Z_SENS\" value=\""+str(p[5]*2**res)+"\" integer=\"16\"/>"]
+
 #
 # print xml for airframe file
 #
 def print_xml(p, sensor, res):
     print("")
-    print("<define name=\""+sensor+"_X_NEUTRAL\" value=\""+str(int(round(p[0])))+"\"/>")
-    print("<define name=\""+sensor+"_Y_NEUTRAL\" value=\""+str(int(round(p[1])))+"\"/>")
-    print("<define name=\""+sensor+"_Z_NEUTRAL\" value=\""+str(int(round(p[2])))+"\"/>")
-    print("<define name=\""+sensor+"_X_SENS\" value=\""+str(p[3]*2**res)+"\" integer=\"16\"/>")
-    print("<define name=\""+sensor+"_Y_SENS\" value=\""+str(p[4]*2**res)+"\" integer=\"16\"/>")
-    print("<define name=\""+sensor+"_Z_SENS\" value=\""+str(p[5]*2**res)+"\" integer=\"16\"/>")
+    for line in get_xml(p, sensor, res):
+        print(line)
+
+#
+# xml for airframe file from an ellipsoid fit
+# the airframe only takes the diagonal, the full matrix is given as a comment
+#
+def get_xml_ellipsoid(q, sensor, res):
+    lines = get_xml(scipy.array([q[0], q[1], q[2], q[3], q[4], q[5]]), sensor, res)
+    lines.append("<!-- "+sensor+" matrix, scaled by 2^"+str(res)+":")
+    for row in ellipsoid_matrix(q):
+        lines.append("     "+" ".join("%.4f" % (v*2**res) for v in row))
+    lines.append("-->")
+    return lines
 
+def print_xml_ellipsoid(q, sensor, res):
+    print("")
+    for line in get_xml_ellipsoid(q, sensor, res):
+        print(line)
 
 
 #
@@ -257,23 +450,69 @@ def plot_mag_3d(measured, calibrated, p):
 # read a turntable log
 # return an array which first column is turnatble and next 3 are gyro
 #
-def read_turntable_log(ac_id, tt_id, filename, _min, _max):
-    f = open(filename, 'r')
-    pattern_g = re.compile("(\S+) "+str(ac_id)+" IMU_GYRO_RAW (\S+) (\S+) (\S+)")
-    pattern_t = re.compile("(\S+) "+str(tt_id)+" IMU_TURNTABLE (\S+)")
-    last_tt = None
-    list_tt = []
-    while True:
-        line = f.readline().strip()
-        if line == '':
-            break
-        m=re.match(pattern_t, line)
-        if m:
-            last_tt = float(m.group(2))
-        m=re.match(pattern_g, line)
-        if m and last_tt and last_tt > _min and last_tt < _max:
-            list_tt.append([last_tt, float(m.group(2)), float(m.group(3)), float(m.group(4))])
-    return scipy.array(list_tt)
+def read_turntable_log(ac_id, tt_id, filename, _min, _max, method='last', tolerance=None):
+    tt = read_log_message(tt_id, filename, "IMU_TURNTABLE")
+    gyro = read_log_message(ac_id, filename, "IMU_GYRO_RAW")
+    # turntable rate at the time of each gyro sample
+    omega, valid = merge_on_time(gyro[log_reader.TIME_FIELD], tt[log_reader.TIME_FIELD], tt['omega'], method, tolerance)
+    sel = valid & (omega != 0) & (omega > _min) & (omega < _max)
+    return scipy.column_stack((omega[sel], get_columns(gyro[sel], SENSOR_FIELDS['GYRO']))) if sel.any() else scipy.array([])
+
+#
+# values of a stream (t, values) at the timestamps t_ref of another one, both sorted in time
+# method is 'last' (last value logged before), 'nearest' or 'interp' (linear interpolation)
+# returns the merged values and the mask of the t_ref with a value at most tolerance (s) away
+#
+def merge_on_time(t_ref, t, values, method='last', tolerance=None):
+    if len(t) == 0:
+        return numpy.zeros(len(t_ref)), numpy.zeros(len(t_ref), dtype=bool)
+    if method == 'last':
+        idx = numpy.searchsorted(t, t_ref, side='right') - 1
+        valid = idx >= 0
+        idx = numpy.maximum(idx, 0)
+        dt = t_ref - t[idx]
+        merged = values[idx]
+    else:
+        right = numpy.minimum(numpy.searchsorted(t, t_ref), len(t) - 1)
+        left = numpy.maximum(right - 1, 0)
+        idx = numpy.where(abs(t_ref - t[left]) <= abs(t[right] - t_ref), left, right)
+        dt = abs(t_ref - t[idx])
+        if method == 'nearest':
+            valid = numpy.ones(len(t_ref), dtype=bool)
+            merged = values[idx]
+        elif method == 'interp':
+            valid = (t_ref >= t[0]) & (t_ref <= t[-1])
+            merged = numpy.interp(t_ref, t, values)
+        else:
+            raise ValueError("unknown merge method " + method)
+    if tolerance is not None:
+        valid &= dt <= tolerance
+    return merged, valid
+
+#
+# minimum correlation of a gyro axis with the turntable rate to calibrate it
+#
+GYRO_MIN_R = 0.95
+
+#
+# linear regression of the three gyros against the turntable rate
+# returns (axis, a, b, r, std error) of the axes correlated by at least min_r
+#
+def fit_gyro(samples, min_r=GYRO_MIN_R):
+    fits = []
+    for axis_idx, axis in ((1, 'P'), (2, 'Q'), (3, 'R')):
+        a, b, r, tt, stderr = stats.linregress(samples[:, 0], samples[:, axis_idx])
+        # constant axes give a nan correlation
+        if abs(r) >= min_r:
+            fits.append((axis, a, b, r, stderr))
+    return fits
+
+#
+# xml defines of a gyro fit
+#
+def get_gyro_xml(axis, a, b):
+    return ['<define name="GYRO_%s_NEUTRAL" value="%d"/>' % (axis, b),
+            '<define name="GYRO_%s_SENS" value="%f" integer="16"/>' % (axis, pow(2, 12)/a)]
 
 #
 #
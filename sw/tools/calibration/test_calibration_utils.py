@@ -0,0 +1,91 @@
+import unittest
+import numpy
+from scipy import linalg
+import calibration_utils
+
+def reference_filter_meas(meas, window_size, noise_threshold):
+    # the loop filter_meas used before the cumulative sums
+    filtered_meas = []
+    filtered_idx = []
+    for i in range(window_size, len(meas)-window_size):
+        noise = meas[i-window_size:i+window_size,:].std(axis=0)
+        if linalg.norm(noise) < noise_threshold:
+            filtered_meas.append(meas[i,:])
+            filtered_idx.append(i)
+    return numpy.array(filtered_meas), filtered_idx
+
+class TestFilterMeas(unittest.TestCase):
+
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        # quiet and noisy stretches around large raw values
+        noise = numpy.repeat(random.uniform(0.5, 20, 40), 25)[:, numpy.newaxis]
+        self.meas = 3000 + numpy.cumsum(random.normal(size=(1000, 3)), axis=0) + noise * random.normal(size=(1000, 3))
+
+    def test_same_as_loop(self):
+        """The cumulative sum windows keep the samples the loop kept."""
+        for (window_size, noise_threshold) in ((1, 5), (10, 10), (10, 30), (50, 40)):
+            flt_meas, flt_idx = calibration_utils.filter_meas(self.meas, window_size, noise_threshold)
+            ref_meas, ref_idx = reference_filter_meas(self.meas, window_size, noise_threshold)
+            self.assertTrue(len(ref_idx) > 0)
+            self.assertEqual(flt_idx, ref_idx)
+            self.assertTrue((flt_meas == ref_meas).all())
+
+    def test_short(self):
+        """Too few samples for a window keep nothing."""
+        flt_meas, flt_idx = calibration_utils.filter_meas(self.meas[:20], 10, 1e6)
+        self.assertEqual(flt_idx, [])
+        self.assertEqual(len(flt_meas), 0)
+
+    def test_chunks(self):
+        """Filtering in parts keeps the samples of a single pass."""
+        chunks = [self.meas[i:i+130] for i in range(0, len(self.meas), 130)]
+        flt_idx = []
+        for (chunk_meas, chunk_idx) in calibration_utils.filter_meas_chunks(chunks, 10, 30):
+            self.assertTrue((chunk_meas == self.meas[chunk_idx]).all())
+            flt_idx.extend(chunk_idx)
+        self.assertEqual(flt_idx, calibration_utils.filter_meas(self.meas, 10, 30)[1])
+
+class TestMergeOnTime(unittest.TestCase):
+
+    def setUp(self):
+        self.t = numpy.array([1.0, 2.0, 3.0, 5.0])
+        self.values = numpy.array([10.0, 20.0, 30.0, 50.0])
+        self.t_ref = numpy.array([0.5, 1.0, 1.4, 2.6, 4.1, 6.0])
+
+    def test_last(self):
+        """Each reference time takes the last value logged before it."""
+        merged, valid = calibration_utils.merge_on_time(self.t_ref, self.t, self.values)
+        self.assertEqual(valid.tolist(), [False, True, True, True, True, True])
+        self.assertEqual(merged[valid].tolist(), [10.0, 10.0, 20.0, 30.0, 50.0])
+
+    def test_nearest(self):
+        """Each reference time takes the closest value."""
+        merged, valid = calibration_utils.merge_on_time(self.t_ref, self.t, self.values, 'nearest')
+        self.assertTrue(valid.all())
+        self.assertEqual(merged.tolist(), [10.0, 10.0, 10.0, 30.0, 50.0, 50.0])
+
+    def test_interp(self):
+        """Values are interpolated within the time range of the stream."""
+        merged, valid = calibration_utils.merge_on_time(self.t_ref, self.t, self.values, 'interp')
+        self.assertEqual(valid.tolist(), [False, True, True, True, True, False])
+        numpy.testing.assert_allclose(merged[valid], [10.0, 14.0, 26.0, 41.0])
+
+    def test_tolerance(self):
+        """Values further than the tolerance are not valid."""
+        merged, valid = calibration_utils.merge_on_time(self.t_ref, self.t, self.values, 'last', 0.5)
+        self.assertEqual(valid.tolist(), [False, True, True, False, False, False])
+        merged, valid = calibration_utils.merge_on_time(self.t_ref, self.t, self.values, 'nearest', 0.5)
+        self.assertEqual(valid.tolist(), [True, True, True, True, False, False])
+
+    def test_empty(self):
+        """An empty stream merges nothing."""
+        merged, valid = calibration_utils.merge_on_time(self.t_ref, numpy.array([]), numpy.array([]))
+        self.assertEqual(len(merged), len(self.t_ref))
+        self.assertFalse(valid.any())
+
+    def test_unknown_method(self):
+        self.assertRaises(ValueError, calibration_utils.merge_on_time, self.t_ref, self.t, self.values, 'spline')
+
+if __name__ == '__main__':
+    unittest.main()